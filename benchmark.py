@@ -0,0 +1,390 @@
+import argparse
+import configparser
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import sqlparse
+
+from main import DREMIO_RESERVED, ModelRewriter, contains_non_alphanumeric, open_ndjson
+
+try:
+    from sql_metadata import Parser
+except ImportError:
+    Parser = None
+
+# view definitions in the shapes seen in real semantic layers: star schemas, ctes,
+# correlated subqueries, comma joins, quoted and backtick identifiers and
+# tables whose names are prefixes of each other
+CORPUS = [
+    '''SELECT l_returnflag, l_linestatus, SUM(l_quantity) AS sum_qty, SUM(l_extendedprice) AS sum_base_price,
+    SUM(l_extendedprice * (1 - l_discount)) AS sum_disc_price, AVG(l_quantity) AS avg_qty, COUNT(*) AS count_order
+    FROM lake.tpch.lineitem WHERE l_shipdate <= DATE '1998-12-01' - INTERVAL '90' DAY
+    GROUP BY l_returnflag, l_linestatus ORDER BY l_returnflag, l_linestatus''',
+    '''SELECT l.l_orderkey, SUM(l.l_extendedprice * (1 - l.l_discount)) AS revenue, o.o_orderdate, o.o_shippriority
+    FROM lake.tpch.customer c, lake.tpch.orders o, lake.tpch.lineitem l
+    WHERE c.c_mktsegment = 'BUILDING' AND c.c_custkey = o.o_custkey AND l.l_orderkey = o.o_orderkey
+    AND o.o_orderdate < DATE '1995-03-15' AND l.l_shipdate > DATE '1995-03-15'
+    GROUP BY l.l_orderkey, o.o_orderdate, o.o_shippriority ORDER BY revenue DESC, o.o_orderdate LIMIT 10''',
+    '''SELECT n.n_name, SUM(l.l_extendedprice * (1 - l.l_discount)) AS revenue
+    FROM lake.tpch.customer c JOIN lake.tpch.orders o ON c.c_custkey = o.o_custkey
+    JOIN lake.tpch.lineitem l ON l.l_orderkey = o.o_orderkey JOIN lake.tpch.supplier s ON l.l_suppkey = s.s_suppkey
+    JOIN lake.tpch.nation n ON s.s_nationkey = n.n_nationkey JOIN lake.tpch.region r ON n.n_regionkey = r.r_regionkey
+    WHERE r.r_name = 'ASIA' AND o.o_orderdate >= DATE '1994-01-01' GROUP BY n.n_name ORDER BY revenue DESC''',
+    '''WITH recent AS (SELECT * FROM Sales.curated.orders WHERE order_date > CURRENT_DATE - 30),
+    archived AS (SELECT * FROM Sales.curated.orders_archive WHERE order_date > CURRENT_DATE - 365)
+    SELECT r.customer_id, COUNT(*) AS orders, SUM(r.amount) AS amount, MAX(a.order_date) AS last_archived
+    FROM recent r LEFT JOIN archived a ON r.customer_id = a.customer_id
+    WHERE r.customer_id IN (SELECT customer_id FROM Sales.curated.customers WHERE "region" = 'EMEA')
+    GROUP BY r.customer_id''',
+    '''SELECT o.`date`, o.`user`, o.`value`, `Sales`.`curated`.`orders_archive`.amount
+    FROM `Sales`.`curated`.`orders_archive` JOIN `Sales`.`curated`.`orders` o ON o.id = orders_archive.id''',
+    '''SELECT c.c_name, c.c_custkey, o.o_orderkey, o.o_orderdate, o.o_totalprice, SUM(l.l_quantity)
+    FROM lake.tpch.customer c, lake.tpch.orders o, lake.tpch.lineitem l
+    WHERE o.o_orderkey IN (SELECT l_orderkey FROM lake.tpch.lineitem GROUP BY l_orderkey HAVING SUM(l_quantity) > 300)
+    AND c.c_custkey = o.o_custkey AND o.o_orderkey = l.l_orderkey
+    GROUP BY c.c_name, c.c_custkey, o.o_orderkey, o.o_orderdate, o.o_totalprice
+    ORDER BY o.o_totalprice DESC, o.o_orderdate LIMIT 100''',
+    '''SELECT "Customer Id", EXTRACT(YEAR FROM "Order Date") AS order_year, SUM("Net Amount") AS net
+    FROM "Finance Space"."Curated Data"."Order Lines" WHERE "Net Amount" > 0 GROUP BY 1, 2''',
+    '''SELECT e.*, d.name AS department FROM hr.people.employees e
+    LEFT JOIN hr.people.departments d ON e.department_id = d.id
+    WHERE EXISTS (SELECT 1 FROM hr.people.employees_history h WHERE h.employee_id = e.id AND h.changed > e.hired)''',
+    # unqualified names resolved through sql_context that sqlparse lexes as keywords
+    '''SELECT e.id, d.payload, u.name FROM events e JOIN data d ON e.id = d.id
+    LEFT JOIN source s ON s.id = e.source_id, user u WHERE u.id = e.user_id''',
+    '''SELECT r.* FROM raw r, public p, system s, archive a WHERE r.id = p.id AND p.id = s.id AND s.id = a.id''',
+    '''SELECT v.id FROM version v JOIN schema s ON v.id = s.id JOIN catalog c ON c.id = s.id JOIN path p ON p.id = c.id''',
+    '''SELECT * FROM Marketing.crm.events, user WHERE events.user_id = user.id''',
+    # comparisons that read like a from clause
+    '''SELECT o.id FROM Sales.curated.orders o JOIN Sales.curated.orders_archive a ON o.id = a.id
+    WHERE o.status IS DISTINCT FROM a.status OR o.amount IS NOT DISTINCT FROM a.amount''',
+]
+
+
+def build_view_sql(joins):
+    # a wide view definition joining many tables, with reserved words used as column names
+    columns = [f't{x}.`value`, t{x}.`date`, t{x}.id_{x}' for x in range(joins)]
+    query = 'select ' + ', '.join(columns) + ' from space.folder.base_table t0'
+    for x in range(1, joins):
+        query += f' join space.folder.table_{x} t{x} on t0.id = t{x}.id'
+    return query
+
+
+def source_reference(table):
+    return "{{ source('" + '_'.join(table.split('.')[:-1]) + "', '" + table.split('.')[-1] + "') }}"
+
+
+def legacy_rewrite(query, tables, reserved):
+    # the rewrite build_model used to do, one replace and one re.sub per reserved word for every table
+    for query_table in tables:
+        query = query.replace("`", '')
+        query = query.replace(query_table, source_reference(query_table))
+        for value in reserved:
+            pattern = rf'`({re.escape(value)})`'
+            query = re.sub(pattern, r'"\1"', query)
+    return query
+
+
+def legacy_pipeline(sql):
+    # sql_metadata parse, rewrite and a second tokenization in sqlparse.format
+    sql_obj = Parser(sql)
+    return sqlparse.format(legacy_rewrite(sql_obj.query, sql_obj.tables, DREMIO_RESERVED), reindent=True)
+
+
+def current_pipeline(rewriter, sql):
+    tokens = rewriter.tokenize(sql)
+    references = rewriter.table_references(tokens)
+    return rewriter.render(tokens, references, {name: source_reference(name) for _, _, name in references})
+
+
+def time_call(func, repeat):
+    start = perf_counter()
+    for _ in range(repeat):
+        func()
+    return (perf_counter() - start) / repeat
+
+
+def bench_rewrite(args):
+    if Parser is None:
+        raise SystemExit('the rewrite benchmark compares against sql_metadata, pip install sql-metadata')
+
+    rewriter = ModelRewriter(DREMIO_RESERVED)
+    print(f'{"joins":>6} {"sql chars":>10} {"legacy ms":>10} {"current ms":>11} {"speedup":>8}')
+    for joins in args.joins:
+        sql = build_view_sql(joins)
+        legacy = time_call(lambda: legacy_pipeline(sql), args.repeat)
+        current = time_call(lambda: current_pipeline(rewriter, sql), args.repeat)
+        print(f'{joins:>6} {len(sql):>10} {legacy * 1000:>10.2f} {current * 1000:>11.2f} {legacy / current:>7.1f}x')
+
+
+def bench_pipeline(args):
+    if Parser is None:
+        raise SystemExit('the pipeline benchmark compares against sql_metadata, pip install sql-metadata')
+
+    rewriter = ModelRewriter(DREMIO_RESERVED)
+    legacy_total = 0
+    current_total = 0
+    print(f'{"view":>5} {"tables":>7} {"legacy ms":>10} {"current ms":>11}  notes')
+    for number, sql in enumerate(CORPUS):
+        legacy = time_call(lambda: legacy_pipeline(sql), args.repeat)
+        current = time_call(lambda: current_pipeline(rewriter, sql), args.repeat)
+        legacy_total += legacy
+        current_total += current
+
+        # report where the two disagree on which tables are referenced, and references
+        # the sequential str.replace broke by rewriting a prefix of a longer table name
+        notes = []
+        tokens = rewriter.tokenize(sql)
+        found = list(dict.fromkeys(name for _, _, name in rewriter.table_references(tokens)))
+        if found != Parser(sql).tables:
+            notes.append(f'tables {found} vs sql_metadata {Parser(sql).tables}')
+        if re.search(r"\}\}\w", legacy_pipeline(sql)):
+            notes.append('legacy output splices a reference into a longer name')
+        print(f'{number:>5} {len(found):>7} {legacy * 1000:>10.2f} {current * 1000:>11.2f}  {"; ".join(notes)}')
+
+    print(f'{"total":>5} {"":>7} {legacy_total * 1000:>10.2f} {current_total * 1000:>11.2f}  '
+          f'{legacy_total / current_total:.1f}x faster')
+
+
+# synthetic catalogs: sources and spaces with nested folders, names with spaces and dashes that need quoting and
+# reserved words as folder, dataset and column names. views join a few earlier tables and views so the
+# dependency graph gets deep, some are defined with a sql_context and refer to their first input by name only
+SOURCES = ['lake', 'pg_prod', 'Finance Space', 'mongo-events', 'S3 Landing']
+SPACES = ['Analytics', 'Marketing', 'Data Products', 'finance']
+FOLDERS = ['raw', 'curated', 'sales', 'crm', 'Order Lines', 'user', 'date', 'eu-west', 'staging', 'value']
+NAMES = ['orders', 'customers', 'line items', 'events', 'payments', 'sessions', 'products', 'accounts']
+COLUMNS = ['id', 'customer_id', 'amount', 'value', 'date', 'user', 'timestamp', 'Net Amount', 'status']
+CREATED = datetime(2024, 1, 1)
+RESERVED_COLUMNS = [column for column in COLUMNS if column.lower() in DREMIO_RESERVED]
+
+
+def dataset_path(random_gen, roots, number):
+    components = [random_gen.choice(roots)]
+    components += random_gen.sample(FOLDERS, random_gen.randint(0, 3))
+    if random_gen.random() < 0.02:
+        # a dataset named after a reserved word, in a folder of its own so the path stays unique
+        components += [f'set_{number}', random_gen.choice(RESERVED_COLUMNS)]
+    else:
+        components.append(f'{random_gen.choice(NAMES)}_{number}')
+    return components
+
+
+def quote_component(random_gen, component):
+    if component.lower() in DREMIO_RESERVED and random_gen.random() < 0.5:
+        return f'`{component}`'
+    if contains_non_alphanumeric(component) or component.lower() in DREMIO_RESERVED:
+        return '"' + component + '"'
+    return component
+
+
+def quote_column(random_gen, alias, column):
+    return f'{alias}.{quote_component(random_gen, column)}'
+
+
+def catalog_row(components, name_key, number):
+    return {name_key: components[-1],
+            'path': '[' + ', '.join(components) + ']',
+            'created': (CREATED + timedelta(seconds=number)).strftime('%Y-%m-%d %H:%M:%S.000')}
+
+
+def view_sql(random_gen, inputs, context):
+    references = []
+    for position, components in enumerate(inputs):
+        if position == 0 and context:
+            # resolved through the view's sql_context
+            references.append(quote_component(random_gen, components[-1]))
+        else:
+            references.append('.'.join(quote_component(random_gen, item) for item in components))
+
+    shape = random_gen.random()
+    columns = ', '.join(quote_column(random_gen, f't{position}', random_gen.choice(COLUMNS))
+                        for position in range(len(references)) for _ in range(2))
+    if shape < 0.6 or len(references) == 1:
+        query = f'SELECT {columns} FROM {references[0]} t0'
+        for position, reference in enumerate(references[1:], start=1):
+            join = random_gen.choice(['JOIN', 'LEFT JOIN', 'INNER JOIN'])
+            query += f' {join} {reference} t{position} ON t0.id = t{position}.id'
+        query += f" WHERE t0.{quote_component(random_gen, 'status')} = 'open'"
+        if shape < 0.2:
+            query += ' GROUP BY 1, 2'
+    elif shape < 0.8:
+        query = f'WITH base AS (SELECT * FROM {references[0]} WHERE amount > 0) SELECT {columns} FROM base t0'
+        for position, reference in enumerate(references[1:], start=1):
+            query += f', {reference} t{position}'
+        query += ' WHERE ' + ' AND '.join(f't0.id = t{position}.id' for position in range(1, len(references)))
+    else:
+        query = f'SELECT {columns.split(", ")[0]} FROM {references[0]} t0 WHERE EXISTS ('
+        query += ' UNION ALL '.join(f'SELECT 1 FROM {reference} t{position} WHERE t{position}.id = t0.id'
+                                    for position, reference in enumerate(references[1:], start=1))
+        query += ')'
+    return query
+
+
+def generate_catalog(datasets, out_dir, seed=0, table_share=0.4, max_fan_out=8, compression=''):
+    # writes tables.json and views.json in the ndjson layout get_local_tables/get_local_views read
+    random_gen = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    table_file = os.path.join(out_dir, 'tables.json' + compression)
+    view_file = os.path.join(out_dir, 'views.json' + compression)
+
+    tables = max(1, int(datasets * table_share))
+    created = []
+    with open_ndjson(table_file, 'w') as file:
+        for number in range(tables):
+            components = dataset_path(random_gen, SOURCES, number)
+            created.append(components)
+            file.write(json.dumps(catalog_row(components, 'table_name', number)) + '\n')
+
+    with open_ndjson(view_file, 'w') as file:
+        for number in range(tables, datasets):
+            components = dataset_path(random_gen, SPACES, number)
+            # mostly recent datasets so chains of views build up, now and then anything in the catalog
+            window = created[-2000:] if random_gen.random() < 0.9 else created
+            inputs = random_gen.sample(window, min(len(window), random_gen.randint(1, max_fan_out)))
+            context = '.'.join(inputs[0][:-1]) if random_gen.random() < 0.2 else random_gen.choice([None, ''])
+            row = catalog_row(components, 'view_name', number)
+            row['sql_definition'] = view_sql(random_gen, inputs, context)
+            row['sql_context'] = context
+            file.write(json.dumps(row) + '\n')
+            created.append(components)
+
+    return table_file, view_file
+
+
+def write_export_config(work_dir, table_file, view_file, args):
+    # a local mode target pointing at the generated catalog and an empty dbt project
+    project_dir = os.path.join(work_dir, 'project', 'bench')
+    os.makedirs(project_dir, exist_ok=True)
+    with open(os.path.join(project_dir, 'dbt_project.yml'), 'w') as file:
+        file.write("name: bench\nversion: '1.0.0'\nprofile: bench\nmodels:\n  bench: {}\n")
+
+    config = configparser.ConfigParser()
+    config['bench'] = {'type': 'software', 'host': 'localhost', 'port': '9047', 'ssl': 'false',
+                       'username': '', 'password': '', 'project_name': 'bench',
+                       'output': os.path.join(work_dir, 'project'),
+                       'view_query': '', 'view_filter': '', 'table_query': '', 'table_filter': '',
+                       'local': 'true', 'local_table_json': table_file, 'local_view_json': view_file,
+                       'parse_cache': str(args.parse_cache).lower()}
+    config_file = os.path.join(work_dir, 'config.ini')
+    with open(config_file, 'w') as file:
+        config.write(file)
+    return config_file
+
+
+def run_export(config_file, metrics_file, args, incremental=False):
+    # the exporter runs in its own process so the peak rss belongs to that export alone
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'),
+               '-config', config_file, '-target', 'bench', '-workers', str(args.workers), '-metrics', metrics_file]
+    if incremental:
+        command.append('-incremental')
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f'export failed:\n{result.stdout[-2000:]}{result.stderr[-2000:]}')
+    with open(metrics_file) as file:
+        return json.load(file)
+
+
+def bench_export(args):
+    # local mode has no catalog stage, the files are read by the stages going through them. catalog_read
+    # is the part of their time spent decoding the files
+    stages = ['build_model', 'build_yaml']
+    results = {}
+    print(f'{"datasets":>9} {"run":>5} ' + ' '.join(f'{name:>24}' for name in stages) +
+          f' {"catalog_read":>24} {"wall s":>8} {"rss MB":>8} {"workers MB":>10}')
+    for datasets in args.datasets:
+        work_dir = os.path.join(args.work_dir, str(datasets))
+        table_file, view_file = generate_catalog(datasets, work_dir, seed=args.seed, compression=args.compression)
+        config_file = write_export_config(work_dir, table_file, view_file, args)
+
+        runs = [('cold', False)]
+        if args.warm:
+            runs.append(('warm', True))
+        for run, incremental in runs:
+            metrics = run_export(config_file, os.path.join(work_dir, f'metrics_{run}.json'), args, incremental)
+            seconds = {name: stage['seconds'] for name, stage in metrics['stages'].items()}
+            read = metrics['timers'].get('catalog_read', {'seconds': 0})['seconds']
+            memory = metrics['peak_memory_mb'] or {'self': 0, 'workers': 0}
+            results[f'{datasets}/{run}'] = {'stages': seconds, 'catalog_read': read,
+                                            'wall_seconds': metrics['wall_seconds'], 'peak_memory_mb': memory}
+            print(f'{datasets:>9} {run:>5} ' + ' '.join(f'{seconds.get(name, 0):>24.3f}' for name in stages) +
+                  f' {read:>24.3f} {metrics["wall_seconds"]:>8.2f} {memory["self"]:>8.1f} {memory["workers"]:>10.1f}')
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        compare_baseline(results, args.baseline, args.tolerance)
+
+
+def compare_baseline(results, baseline_file, tolerance):
+    # fail when a stage got slower than the saved baseline by more than the tolerance
+    with open(baseline_file) as file:
+        baseline = json.load(file)
+
+    regressions = []
+    for run, result in results.items():
+        if run not in baseline:
+            continue
+        for name, seconds in result['stages'].items():
+            before = baseline[run]['stages'].get(name)
+            # stages under 50ms are mostly noise
+            if before is not None and seconds > 0.05 and seconds > before * (1 + tolerance):
+                regressions.append(f'{run} {name}: {before:.3f}s -> {seconds:.3f}s')
+
+    if regressions:
+        print('regressions against ' + baseline_file)
+        for regression in regressions:
+            print('  ' + regression)
+        raise SystemExit(1)
+    print(f'no stage slower than {baseline_file} by more than {tolerance:.0%}')
+
+
+def bench_generate(args):
+    table_file, view_file = generate_catalog(args.datasets, args.out, seed=args.seed, compression=args.compression)
+    print(f'wrote {table_file} and {view_file}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='dremio-dbt-exporter-benchmark',
+        description='benchmarks for the dremio dbt exporter')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    rewrite_parser = subparsers.add_parser('rewrite', help='per view cost of rewriting wide join definitions')
+    rewrite_parser.add_argument('-joins', type=int, nargs='+', default=[1, 10, 50, 100])
+    rewrite_parser.add_argument('-repeat', type=int, default=5)
+    rewrite_parser.set_defaults(func=bench_rewrite)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='parse, rewrite and format a corpus of view definitions')
+    pipeline_parser.add_argument('-repeat', type=int, default=20)
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    generate_parser = subparsers.add_parser('generate', help='write a synthetic sys.tables/sys.views catalog')
+    generate_parser.add_argument('-datasets', type=int, default=1000)
+    generate_parser.add_argument('-out', default='bench_catalog')
+    generate_parser.add_argument('-seed', type=int, default=0)
+    generate_parser.add_argument('-compression', choices=['', '.gz', '.zst'], default='')
+    generate_parser.set_defaults(func=bench_generate)
+
+    export_parser = subparsers.add_parser('export', help='end to end local mode export of synthetic catalogs')
+    export_parser.add_argument('-datasets', type=int, nargs='+', default=[1000, 10000, 100000])
+    export_parser.add_argument('-work-dir', dest='work_dir', default='bench_export')
+    export_parser.add_argument('-seed', type=int, default=0)
+    export_parser.add_argument('-compression', choices=['', '.gz', '.zst'], default='')
+    export_parser.add_argument('-workers', type=int, default=1)
+    export_parser.add_argument('-parse-cache', dest='parse_cache', action='store_true',
+                               help='keep the parse cache on, a cold run then also pays for filling it')
+    export_parser.add_argument('-warm', action='store_true', help='run a second, incremental export')
+    export_parser.add_argument('-save', help='write the results as json for use as a baseline')
+    export_parser.add_argument('-baseline', help='fail if a stage is slower than in this saved result')
+    export_parser.add_argument('-tolerance', type=float, default=0.25)
+    export_parser.set_defaults(func=bench_export)
+
+    args = parser.parse_args()
+    args.func(args)
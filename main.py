@@ -3,191 +3,442 @@ import configparser
 from datetime import datetime
 import json
 import requests
-from time import sleep
+from requests.adapters import HTTPAdapter
+import random
+from time import sleep, time, perf_counter
 import sys
-import math
-from sql_metadata import Parser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from itertools import islice
 from os import makedirs
 import os
 import sqlparse
+from sqlparse import tokens as T
+from sqlparse.engine import grouping
+from sqlparse.engine.statement_splitter import StatementSplitter
+from sqlparse.filters import SerializerUnicode
 import ruamel.yaml
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import resource
+except ImportError:
+    resource = None
 import logging
 import re
-import ast
+from functools import lru_cache
+import hashlib
+import gzip
+import sqlite3
+import threading
+import multiprocessing
+import heapq
+import cProfile
+from contextlib import contextmanager
+from functools import wraps
+import io
+import fnmatch
+
+# Dremio reserved words
+DREMIO_RESERVED = frozenset({'abs', 'all', 'allocate', 'allow', 'alter', 'and', 'any', 'are', 'array',
+    'array_max_cardinality', 'as', 'asensitivelo', 'asymmetric', 'at', 'atomic', 'authorization',
+    'avg', 'begin', 'begin_frame', 'begin_partition', 'between', 'bigint', 'binary', 'bit', 'blob',
+    'boolean', 'both', 'by', 'call', 'called', 'cardinality', 'cascaded', 'case', 'cast', 'ceil',
+    'ceiling', 'char', 'char_length', 'character', 'character_length', 'check', 'classifier',
+    'clob', 'close', 'coalesce', 'collate', 'collect', 'column', 'commit', 'condition', 'connect',
+    'constraint', 'contains', 'convert', 'corr', 'corresponding', 'count', 'covar_pop',
+    'covar_samp', 'create', 'cross', 'cube', 'cume_dist', 'current', 'current_catalog',
+    'current_date', 'current_default_transform_group', 'current_path', 'current_role',
+    'current_row', 'current_schema', 'current_time', 'current_timestamp',
+    'current_transform_group_for_type', 'current_user', 'cursor', 'cycle', 'date', 'day',
+    'deallocate', 'dec', 'decimal', 'declare', 'default', 'define', 'delete', 'dense_rank',
+    'deref', 'describe', 'deterministic', 'disallow', 'disconnect', 'distinct', 'double', 'drop',
+    'dynamic', 'each', 'element', 'else', 'empty', 'end', 'end-exec', 'end_frame', 'end_partition',
+    'equals', 'escape', 'every', 'except', 'exec', 'execute', 'exists', 'exp', 'explain', 'extend',
+    'external', 'extract', 'false', 'fetch', 'filter', 'first_value', 'float', 'floor', 'for',
+    'foreign', 'frame_row', 'free', 'from', 'full', 'function', 'fusion', 'get', 'global', 'grant',
+    'group', 'grouping', 'groups', 'having', 'hold', 'hour', 'identity', 'import', 'in',
+    'indicator', 'initial', 'inner', 'inout', 'insensitive', 'insert', 'int', 'integer',
+    'intersect', 'intersection', 'interval', 'into', 'is', 'join', 'lag', 'language', 'large',
+    'last_value', 'lateral', 'lead', 'leading', 'left', 'like', 'like_regex', 'limit', 'ln',
+    'local', 'localtime', 'localtimestamp', 'lower', 'match', 'matches', 'match_number',
+    'match_recognize', 'max', 'measures', 'member', 'merge', 'method', 'min', 'minute', 'mod',
+    'modifies', 'module', 'month', 'more', 'multiset', 'national', 'natural', 'nchar', 'nclob',
+    'new', 'next', 'no', 'none', 'normalize', 'not', 'nth_value', 'ntile', 'null', 'nullif',
+    'numeric', 'occurrences_regex', 'octet_length', 'of', 'offset', 'old', 'omit', 'on', 'one',
+    'only', 'open', 'or', 'order', 'out', 'outer', 'over', 'overlaps', 'overlay', 'parameter',
+    'partition', 'pattern', 'per', 'percent', 'percentile_cont', 'percentile_disc', 'percent_rank',
+    'period', 'permute', 'portion', 'position', 'position_regex', 'power', 'precedes', 'precision',
+    'prepare', 'prev', 'primary', 'procedure', 'range', 'rank', 'reads', 'real', 'recursive',
+    'ref', 'references', 'referencing', 'regr_avgx', 'regr_avgy', 'regr_count', 'regr_intercept',
+    'regr_r2', 'regr_slope', 'regr_sxx', 'regr_sxy', 'regr_syy', 'release', 'reset', 'result',
+    'return', 'returns', 'revoke', 'right', 'rollback', 'rollup', 'row', 'row_number', 'rows',
+    'running', 'savepoint', 'scope', 'scroll', 'search', 'second', 'seek', 'select', 'sensitive',
+    'session_user', 'set', 'minus', 'show', 'similar', 'skip', 'smallint', 'some', 'specific',
+    'specifictype', 'sql', 'sqlexception', 'sqlstate', 'sqlwarning', 'sqrt', 'start', 'static',
+    'stddev_pop', 'stddev_samp', 'stream', 'submultiset', 'subset', 'substring', 'substring_regex',
+    'succeeds', 'sum', 'symmetric', 'system', 'system_time', 'system_user', 'table', 'tablesample',
+    'then', 'time', 'timestamp', 'timezone_hour', 'timezone_minute', 'tinyint', 'to', 'trailing',
+    'translate', 'translate_regex', 'translation', 'treat', 'trigger', 'trim', 'trim_array',
+    'true', 'truncate', 'uescape', 'union', 'unique', 'unknown', 'unnest', 'update', 'upper',
+    'upsert', 'user', 'using', 'value', 'values', 'value_of', 'var_pop', 'var_samp', 'varbinary',
+    'varchar', 'varying', 'versioning', 'when', 'whenever', 'where', 'width_bucket', 'window',
+    'with', 'within', 'without', 'year'})
+
+
+# bump when the manifest layout or the generated sql changes so incremental exports rebuild everything
+MANIFEST_VERSION = 3
+
+# bump when ModelRewriter output changes, the sqlparse version is part of the key as it formats the models
+PARSE_CACHE_VERSION = f'1-{sqlparse.__version__}'
+
+
+# only one cProfile profiler can run in a process (python 3.12+ refuses to enable a second one),
+# stages nested in a profiled stage or running in other threads at the same time are only timed
+profiler_lock = threading.Lock()
+
+
+class Metrics:
+    # wall time of each pipeline stage, finer grained timers and counters for one export, the slowest views
+    # and peak memory, reported as json. with a profile_dir stages also run under cProfile, one profile
+    # per stage name written to <stage>.pstats
+    def __init__(self, slowest=10, profile_dir=None):
+        self.slowest = slowest
+        self.profile_dir = profile_dir
+        self.profiles = {}
+        self.started = perf_counter()
+        self.stages = {}
+        self.timers = {}
+        self.counters = {}
+        self.views = []
+        self.lock = threading.Lock()
+
+    def add(self, timings, name, seconds):
+        with self.lock:
+            entry = timings.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            entry['seconds'] += seconds
+            entry['calls'] += 1
+
+    @contextmanager
+    def stage(self, name):
+        profiler = None
+        if self.profile_dir and profiler_lock.acquire(blocking=False):
+            profiler = self.profiles.setdefault(name, cProfile.Profile())
+            try:
+                profiler.enable()
+            except ValueError:
+                # another profiling tool (a debugger, coverage) is already active
+                profiler_lock.release()
+                profiler = None
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(self.stages, name, perf_counter() - start)
+            if profiler is not None:
+                profiler.disable()
+                profiler_lock.release()
+                # the profile of a stage adds up over its calls, the file holds all of them so far
+                makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, f'{name}.pstats'))
+
+    @contextmanager
+    def timer(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(self.timers, name, perf_counter() - start)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_view(self, path, timings):
+        # timings measured in the (worker) process that rendered the view
+        for name, seconds in timings.items():
+            self.add(self.timers, name, seconds)
+        total = sum(timings.values())
+        with self.lock:
+            heapq.heappush(self.views, (total, path))
+            if len(self.views) > self.slowest:
+                heapq.heappop(self.views)
+
+    def peak_memory_mb(self):
+        if resource is None:
+            return None
+        # ru_maxrss is kilobytes on linux and bytes on macos
+        scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+        return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+                'workers': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale}
+
+    def report(self):
+        return {'wall_seconds': perf_counter() - self.started,
+                'stages': self.stages,
+                'timers': self.timers,
+                'counters': self.counters,
+                'slowest_views': [{'path': path, 'seconds': seconds}
+                                  for seconds, path in sorted(self.views, reverse=True)],
+                'peak_memory_mb': self.peak_memory_mb()}
+
+    def write(self, file_name):
+        with open(file_name, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+
+
+def instrumented(stage):
+    # times the decorated pipeline function as a stage of the export
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.stage(stage):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
 
 class DremioConfig:
     #TODO:
     # Permissions
-    # Reflections
-    def __init__(self, config):
-        self.dremio_type = config[config_section]['type']
-        self.username = config[config_section]['username']
-        self.password = config[config_section]['password']
-        self.project_name = config[config_section]['project_name']
+    def __init__(self, config, target, session=None):
+        # target is the config section to export
+        section = config[target]
+        self.target = target
+        self.dremio_type = section['type']
+        self.username = section['username']
+        self.password = section['password']
+        self.project_name = section['project_name']
 
         if self.dremio_type == 'cloud':
-            self.project_id = config[config_section]['project_id']
+            self.project_id = section['project_id']
         else:
             self.project_id = None
 
-        self.output = config[config_section]['output']
-        self.schemas = []
-        self.view_query = config[config_section]['view_query']
-        self.view_filter = config[config_section]['view_filter']
-        self.table_query = config[config_section]['table_query']
-        self.table_filter = config[config_section]['table_filter']
-        self.local = config[config_section].getboolean('local')
-        self.local_views = config[config_section]['local_view_json']
-        self.local_tables = config[config_section]['local_table_json']
+        self.output = section['output']
+        self.schema_split = section.get('schema_split', fallback='')
+        if self.schema_split not in ('', 'space', 'folder'):
+            raise DremioError(f'schema_split must be space or folder, not {self.schema_split}')
+        self.view_query = section['view_query']
+        self.view_filter = section['view_filter']
+        self.table_query = section['table_query']
+        self.client_filter = section.getboolean('client_filter', fallback=False)
+        self.view_path_filter = section.get('view_path_filter', fallback='')
+        self.shard = section.getboolean('shard', fallback=False)
+        self.shards = [line.strip() for line in section.get('shards', fallback='').splitlines()
+                       if line.strip()]
+        self.shard_concurrency = section.getint('shard_concurrency', fallback=4)
+        self.shard_retries = section.getint('shard_retries', fallback=2)
+        self.projection = section.getboolean('projection', fallback=True)
+        self.definition_batch_size = section.getint('definition_batch_size', fallback=500)
+        self.definition_concurrency = section.getint('definition_concurrency', fallback=4)
+        self.snapshot_dir = section.get('snapshot_dir', fallback='')
+        self.snapshot_ttl = section.getfloat('snapshot_ttl', fallback=3600)
+        self.tag_column = section.get('tag_column', fallback='tag')
+        self.parse_cache = section.getboolean('parse_cache', fallback=True)
+        self.parse_cache_file = section.get('parse_cache_file', fallback='')
+        self.parse_cache_size_mb = section.getint('parse_cache_size_mb', fallback=256)
+        self.columns = section.getboolean('columns', fallback=False)
+        self.column_query = section.get('column_query', fallback='select TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, '
+                                        'ORDINAL_POSITION, DATA_TYPE from INFORMATION_SCHEMA."COLUMNS"')
+        self.local_columns = section.get('local_column_json', fallback='')
+        self.column_index = {}
+        self.reflections = section.getboolean('reflections', fallback=False)
+        self.reflection_query = section.get('reflection_query', fallback='select * from sys.reflections')
+        self.local_reflections = section.get('local_reflection_json', fallback='')
+        self.reflection_index = {}
+        self.local = section.getboolean('local')
+        self.local_views = section['local_view_json']
+        self.local_tables = section['local_table_json']
 
         # create url string
-        if config[config_section].getboolean('ssl'):
+        if section.getboolean('ssl'):
             self.url = 'https://'
         else:
             self.url = 'http://'
 
-        self.url += config[config_section]['host'] + ":" + config[config_section]['port']
+        self.url += section['host'] + ":" + section['port']
+
+        self.page_size = section.getint('page_size', fallback=500)
+        self.page_concurrency = section.getint('page_concurrency', fallback=4)
+
+        # a connection for every result page in flight: page_concurrency pages for each catalog, shard or
+        # definition job running side by side and for the column and reflection harvests next to them
+        jobs = max(4, self.definition_concurrency, self.shard_concurrency if self.shard else 0)
+        self.pool_size = section.getint('pool_size', fallback=self.page_concurrency
+                                        * (jobs + self.columns + self.reflections))
 
-        # create the header
-        self.headers = authenticate(self)
+        # rest client, logs in on the first request
+        self.client = DremioClient(self,
+                                   session=session,
+                                   retries=section.getint('retries', fallback=3),
+                                   backoff=section.getfloat('retry_backoff', fallback=0.5),
+                                   timeout=section.getfloat('timeout', fallback=60),
+                                   pool_size=self.pool_size)
+        self.poll_min = section.getfloat('poll_min', fallback=0.05)
+        self.poll_max = section.getfloat('poll_max', fallback=5)
 
         # Dremio reserved words
-        self.dremio_reserved = {'abs', 'all', 'allocate', 'allow', 'alter', 'and', 'any', 'are', 'array',
-                       'array_max_cardinality', 'as', 'asensitivelo', 'asymmetric', 'at', 'atomic', 'authorization',
-                       'avg', 'begin', 'begin_frame', 'begin_partition', 'between', 'bigint', 'binary', 'bit', 'blob',
-                       'boolean', 'both', 'by', 'call', 'called', 'cardinality', 'cascaded', 'case', 'cast', 'ceil',
-                       'ceiling', 'char', 'char_length', 'character', 'character_length', 'check', 'classifier',
-                       'clob', 'close', 'coalesce', 'collate', 'collect', 'column', 'commit', 'condition', 'connect',
-                       'constraint', 'contains', 'convert', 'corr', 'corresponding', 'count', 'covar_pop',
-                       'covar_samp', 'create', 'cross', 'cube', 'cume_dist', 'current', 'current_catalog',
-                       'current_date', 'current_default_transform_group', 'current_path', 'current_role',
-                       'current_row', 'current_schema', 'current_time', 'current_timestamp',
-                       'current_transform_group_for_type', 'current_user', 'cursor', 'cycle', 'date', 'day',
-                       'deallocate', 'dec', 'decimal', 'declare', 'default', 'define', 'delete', 'dense_rank',
-                       'deref', 'describe', 'deterministic', 'disallow', 'disconnect', 'distinct', 'double', 'drop',
-                       'dynamic', 'each', 'element', 'else', 'empty', 'end', 'end-exec', 'end_frame', 'end_partition',
-                       'equals', 'escape', 'every', 'except', 'exec', 'execute', 'exists', 'exp', 'explain', 'extend',
-                       'external', 'extract', 'false', 'fetch', 'filter', 'first_value', 'float', 'floor', 'for',
-                       'foreign', 'frame_row', 'free', 'from', 'full', 'function', 'fusion', 'get', 'global', 'grant',
-                       'group', 'grouping', 'groups', 'having', 'hold', 'hour', 'identity', 'import', 'in',
-                       'indicator', 'initial', 'inner', 'inout', 'insensitive', 'insert', 'int', 'integer',
-                       'intersect', 'intersection', 'interval', 'into', 'is', 'join', 'lag', 'language', 'large',
-                       'last_value', 'lateral', 'lead', 'leading', 'left', 'like', 'like_regex', 'limit', 'ln',
-                       'local', 'localtime', 'localtimestamp', 'lower', 'match', 'matches', 'match_number',
-                       'match_recognize', 'max', 'measures', 'member', 'merge', 'method', 'min', 'minute', 'mod',
-                       'modifies', 'module', 'month', 'more', 'multiset', 'national', 'natural', 'nchar', 'nclob',
-                       'new', 'next', 'no', 'none', 'normalize', 'not', 'nth_value', 'ntile', 'null', 'nullif',
-                       'numeric', 'occurrences_regex', 'octet_length', 'of', 'offset', 'old', 'omit', 'on', 'one',
-                       'only', 'open', 'or', 'order', 'out', 'outer', 'over', 'overlaps', 'overlay', 'parameter',
-                       'partition', 'pattern', 'per', 'percent', 'percentile_cont', 'percentile_disc', 'percent_rank',
-                       'period', 'permute', 'portion', 'position', 'position_regex', 'power', 'precedes', 'precision',
-                       'prepare', 'prev', 'primary', 'procedure', 'range', 'rank', 'reads', 'real', 'recursive',
-                       'ref', 'references', 'referencing', 'regr_avgx', 'regr_avgy', 'regr_count', 'regr_intercept',
-                       'regr_r2', 'regr_slope', 'regr_sxx', 'regr_sxy', 'regr_syy', 'release', 'reset', 'result',
-                       'return', 'returns', 'revoke', 'right', 'rollback', 'rollup', 'row', 'row_number', 'rows',
-                       'running', 'savepoint', 'scope', 'scroll', 'search', 'second', 'seek', 'select', 'sensitive',
-                       'session_user', 'set', 'minus', 'show', 'similar', 'skip', 'smallint', 'some', 'specific',
-                       'specifictype', 'sql', 'sqlexception', 'sqlstate', 'sqlwarning', 'sqrt', 'start', 'static',
-                       'stddev_pop', 'stddev_samp', 'stream', 'submultiset', 'subset', 'substring', 'substring_regex',
-                       'succeeds', 'sum', 'symmetric', 'system', 'system_time', 'system_user', 'table', 'tablesample',
-                       'then', 'time', 'timestamp', 'timezone_hour', 'timezone_minute', 'tinyint', 'to', 'trailing',
-                       'translate', 'translate_regex', 'translation', 'treat', 'trigger', 'trim', 'trim_array',
-                       'true', 'truncate', 'uescape', 'union', 'unique', 'unknown', 'unnest', 'update', 'upper',
-                       'upsert', 'user', 'using', 'value', 'values', 'value_of', 'var_pop', 'var_samp', 'varbinary',
-                       'varchar', 'varying', 'versioning', 'when', 'whenever', 'where', 'width_bucket', 'window',
-                       'with', 'within', 'without', 'year'}
-
-
-def authenticate(self):
-    if self.dremio_type == 'cloud':
-        # set cloud header
-        headers = {
-            'Authorization': f'Bearer {self.password}',
-            'Content-Type': 'application/json'
-        }
-        return headers
-    else:
+        self.dremio_reserved = DREMIO_RESERVED
+
+        # stage timings and counters for the export
+        self.metrics = Metrics()
+
+
+class DremioError(Exception):
+    pass
+
+
+def new_session(pool_size=10):
+    # requests beyond pool_size wait for a free connection instead of opening one that is thrown away
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class DremioClient:
+    # keep-alive session for the dremio rest api. 429/5xx responses and dropped connections are retried
+    # with jittered exponential backoff and an expired software token is refreshed on a 401
+    retry_status = {429, 500, 502, 503, 504}
+
+    def __init__(self, dremio, retries=3, backoff=0.5, timeout=60, pool_size=10, session=None):
+        self.dremio = dremio
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.headers = None
+        self.login_lock = threading.Lock()
+
+        # targets on the same dremio can share one session and its connections, the
+        # auth headers are sent with each request so every target keeps its own login
+        self.session = session or new_session(pool_size)
+
+    def api_url(self, path):
+        if self.dremio.dremio_type == 'cloud':
+            return f"{self.dremio.url}/v0/projects/{self.dremio.project_id}/{path}"
+        else:
+            return f"{self.dremio.url}/api/v3/{path}"
+
+    def sleep_backoff(self, attempt, response=None):
+        # honour Retry-After when dremio sends one, otherwise back off with full jitter
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            sleep(int(retry_after))
+        else:
+            sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def send(self, method, url, headers, data=None):
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, headers=headers, data=data, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.retries:
+                    raise DremioError(f'{method} {url} failed after {attempt + 1} attempts: {e}')
+                self.sleep_backoff(attempt)
+            else:
+                if response.status_code not in self.retry_status or attempt >= self.retries:
+                    return response
+                print(f'{datetime.now()} - {response.status_code} from {url}, retrying')
+                self.sleep_backoff(attempt, response)
+            attempt += 1
+
+    def login(self, failed=None):
+        # threads share the login, the first one in logs in and the others use its token. after a 401
+        # only the token that failed is replaced, a thread that lost the race uses the new one
+        with self.login_lock:
+            if self.headers is not None and self.headers is not failed:
+                return self.headers
+            return self.new_login()
+
+    def new_login(self):
+        if self.dremio.dremio_type == 'cloud':
+            # set cloud header
+            self.headers = {
+                'Authorization': f'Bearer {self.dremio.password}',
+                'Content-Type': 'application/json'
+            }
+            return self.headers
 
         # follow software auth path
         payload = json.dumps({
-            "userName": f"{self.username}",
-            "password": f"{self.password}"
+            "userName": f"{self.dremio.username}",
+            "password": f"{self.dremio.password}"
         })
         headers = {
             'Content-Type': 'application/json'
         }
-        url = f"{self.url}/apiv2/login"
+        url = f"{self.dremio.url}/apiv2/login"
 
-        response = requests.request("POST", url, headers=headers, data=payload)
+        response = self.send("POST", url, headers, payload)
 
         # if valid response
         if response.status_code == 200:
             token = response.json()['token']
-            headers = {
+            self.headers = {
                 'Authorization': f'Bearer {token}',
                 'Content-Type': 'application/json'
             }
-            return headers
+            return self.headers
         else:
-            print(f'{datetime.now()} - failed to authenticate')
-            print(f'{datetime.now()} - {response}')
-            sys.exit(1)
+            raise DremioError(f'failed to authenticate: {response}')
 
+    def request(self, method, path, payload=None):
+        headers = self.headers or self.login()
 
-def get_job(self, id):
-    if self.dremio_type == 'cloud':
-        url = f"{self.url}/v0/projects/{self.project_id}/job/{id}"
-    else:
-        url = f"{self.url}/api/v3/job/{id}"
+        url = self.api_url(path)
+        data = json.dumps(payload) if payload is not None else None
+        response = self.send(method, url, headers, data)
 
-    response = requests.request("GET", url, headers=self.headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        print(f'{datetime.now()} - Bad response when getting job {id}')
-        print(response)
-        sys.exit(1)
+        # software tokens expire, log in again and retry once
+        if response.status_code == 401 and self.dremio.dremio_type != 'cloud':
+            headers = self.login(failed=headers)
+            response = self.send(method, url, headers, data)
 
+        if response.status_code != 200:
+            raise DremioError(f'Bad response from {method} {path}: {response.status_code} {response.text[:500]}')
+        self.dremio.metrics.count('requests')
+        self.dremio.metrics.count('bytes_downloaded', len(response.content))
+        return response.json()
 
-def get_results(self, id, offset):
-    if self.dremio_type == 'cloud':
-        url = f"{self.url}/v0/projects/{self.project_id}/job/{id}/results?offset={offset}&limit=500"
-    else:
-        url = f"{self.url}/api/v3/job/{id}/results?offset={offset}&limit=500"
 
-    response = requests.request("GET", url, headers=self.headers)
-    if response.status_code == 200:
-        return response.json()['rows']
-    else:
-        print(f'{datetime.now()} - Bad response when getting job {id}')
-        print(response)
-        sys.exit(1)
+def get_job(self, id):
+    return self.client.request("GET", f"job/{id}")
 
 
-def execute_query_rest(self, query):
-    if self.dremio_type == 'cloud':
-        url = f"{self.url}/v0/projects/{self.project_id}/sql"
-    else:
-        url = f"{self.url}/api/v3/sql"
+def get_results(self, id, offset, limit=500):
+    return self.client.request("GET", f"job/{id}/results?offset={offset}&limit={limit}")['rows']
 
-    payload = json.dumps({
-        "sql": query
-    })
 
-    response = requests.request("POST", url, headers=self.headers, data=payload)
+def stream_results(self, job_id, row_count):
+    # fetch pages concurrently with at most page_concurrency requests in flight,
+    # rows are yielded in order as soon as the page holding them has landed
+    offsets = iter(range(0, row_count, self.page_size))
+    executor = ThreadPoolExecutor(max_workers=self.page_concurrency)
+    try:
+        pages = deque(executor.submit(get_results, self, job_id, offset, self.page_size)
+                      for offset in islice(offsets, self.page_concurrency))
+        while pages:
+            with self.metrics.timer('result_download'):
+                rows = pages.popleft().result()
+            self.metrics.count('rows_fetched', len(rows))
+            offset = next(offsets, None)
+            if offset is not None:
+                pages.append(executor.submit(get_results, self, job_id, offset, self.page_size))
+            yield from rows
+    finally:
+        executor.shutdown(cancel_futures=True)
 
-    if response.status_code == 200:
-        return response.json()['id']
-    else:
-        print(f'{datetime.now()} - Bad response when submitting sql {response.status_code}')
-        print(response)
-        sys.exit(1)
 
+def execute_query_rest(self, query):
+    return self.client.request("POST", "sql", {"sql": query})['id']
 
-def execute_query(self, query):
-    # run the query via rest (arrow flight has too many issues)
-    job_id = execute_query_rest(self, query)
 
+def wait_for_job(self, job_id):
     # pull job status
     # possible job statuses NOT_SUBMITTED, STARTING, RUNNING, COMPLETED,
     # CANCELED, FAILED, CANCELLATION_REQUESTED, PLANNING, PENDING,
@@ -197,77 +448,498 @@ def execute_query(self, query):
                     'PENDING', 'METADATA_RETRIEVAL', 'QUEUED', 'ENGINE_START', 'EXECUTION_PLANNING',
                     'COMPLETED']
 
+    # poll quickly at first so short metadata queries return fast, then back off exponentially
+    poll_interval = self.poll_min
+    last_state = None
+
     while True:
         job = get_job(self, job_id)
         job_state = job['jobState']
         if job_state in valid_status:
-            if job_state == 'COMPLETED':
+            if job_state != last_state:
                 print(f'{datetime.now()} - job state: {job_state}')
                 print(f'{datetime.now()} - job_id: ' + job_id)
-                calls = math.ceil(job['rowCount'] / 500)
-                x = 0
-                results = []
-                while x < calls:
-                    offset = x * 500
-                    results = results + get_results(self, job_id, offset)
-                    x += 1
-                return results
+                last_state = job_state
+
+            if job_state == 'COMPLETED':
+                return job
             else:
-                print(f'{datetime.now()} - job state: {job_state}')
-                print(f'{datetime.now()} - job_id: ' + job_id)
-                sleep(5)
+                sleep(poll_interval)
+                poll_interval = min(poll_interval * 2, self.poll_max)
 
         else:
             print(f'{datetime.now()} - job state not valid')
             print(f'{datetime.now()} - job state: {job_state}')
             print(f'{datetime.now()} - job_id: {job_id}')
-            sys.exit(1)
+            raise DremioError(f'job {job_id} ended in state {job_state}')
 
 
-def get_views(self):
-    query = self.view_query
-    views = execute_query(self, query)
+def stream_job(self, job_id):
+    with self.metrics.timer('job_wait'):
+        job = wait_for_job(self, job_id)
+    self.metrics.count('jobs')
+    yield from stream_results(self, job_id, job['rowCount'])
 
-    self.views = views
 
+def execute_query_stream(self, query):
+    # run the query via rest (arrow flight has too many issues)
+    job_id = execute_query_rest(self, query)
+    yield from stream_job(self, job_id)
 
-def get_filtered_views(self):
-    query = f'{self.view_query} {self.view_filter}'
-    views = execute_query(self, query)
 
-    self.filtered_views = views
+def execute_query(self, query):
+    return list(execute_query_stream(self, query))
+
+
+def snapshot_files(self, query):
+    # snapshots are keyed by the dremio and target they came from and the query that produced them,
+    # targets on the same dremio can log in as users that see different catalogs
+    key = json.dumps([self.url, self.project_id, self.target, self.username, query])
+    key = hashlib.sha256(key.encode()).hexdigest()
+    base = os.path.join(self.snapshot_dir, key)
+    return base + '.json', base + '.ndjson.gz'
+
+
+def load_snapshot(self, query):
+    meta_file, rows_file = snapshot_files(self, query)
+    if not os.path.exists(meta_file) or not os.path.exists(rows_file):
+        return None, None
+
+    with open(meta_file) as file:
+        meta = json.load(file)
+    with gzip.open(rows_file, 'rt') as file:
+        rows = [json.loads(line) for line in file]
+    return meta, rows
+
+
+def save_snapshot(self, query, rows):
+    meta_file, rows_file = snapshot_files(self, query)
+    makedirs(self.snapshot_dir, exist_ok=True)
+
+    with gzip.open(rows_file, 'wt') as file:
+        for row in rows:
+            file.write(json.dumps(row) + '\n')
+    with open(meta_file, 'w') as file:
+        json.dump({'query': query,
+                   'fetched_at': time(),
+                   'rows': len(rows)}, file)
+
+
+def refresh_rows(self, name, query, rows, versions):
+    # versions are the path and tag of every dataset now. dremio gives a dataset a new tag whenever
+    # it is edited, so new paths and changed tags are fetched again and paths that are gone drop out
+    tag = self.tag_column
+    current = {row['path']: row for row in rows}
+    changed = {version['path'] for version in versions
+               if version['path'] not in current or current[version['path']].get(tag) != version[tag]}
+    fetched = {row['path']: row for row in fetch_paths(self, query, sorted(changed))}
+
+    refreshed = []
+    for version in versions:
+        row = fetched.get(version['path']) if version['path'] in changed else current[version['path']]
+        if row is not None:
+            refreshed.append(row)
+    removed = len(current.keys() - {version['path'] for version in versions})
+    print(f'{datetime.now()} - refreshed {name} snapshot: {len(changed)} new or edited, {removed} removed')
+    return refreshed
+
+
+def run_queries(self, queries, refresh=False, record=None):
+    # submit every query up front so dremio runs them side by side, then wait on and
+    # download all of them together. takes a dict of name: query and returns name: rows.
+    # with a snapshot_dir fresh snapshots are used as is, expired ones are fetched again
+    # and refresh only fetches the rows of datasets added or edited since the snapshot was taken.
+    # record maps names to ndjson files the final rows are written to
+    record = record or {}
+    results = {}
+    snapshots = {}
+    job_ids = {}
+
+    loaded = {name: load_snapshot(self, query) if self.snapshot_dir else (None, None)
+              for name, query in queries.items()}
+    for name, (meta, rows) in loaded.items():
+        # without the tag edited datasets can't be told apart from unchanged ones
+        if meta is not None and refresh and any(self.tag_column not in row for row in rows):
+            raise DremioError(f'-refresh needs the "{self.tag_column}" column in the {name} '
+                              f'catalog to find edited datasets, set tag_column')
+
+    for name, query in queries.items():
+        meta, rows = loaded[name]
+        if meta is not None and refresh:
+            taken = datetime.fromtimestamp(meta['fetched_at'])
+            print(f'{datetime.now()} - refreshing {name} snapshot taken at {taken}')
+            snapshots[name] = rows
+            job_ids[name] = execute_query_rest(self, project_query(query, ['path', self.tag_column]))
+        elif meta is not None and not refresh and time() - meta['fetched_at'] < self.snapshot_ttl:
+            print(f'{datetime.now()} - using {name} snapshot with {meta["rows"]} rows')
+            results[name] = rows
+        else:
+            job_ids[name] = execute_query_rest(self, query)
+
+    def fetch(name, job_id):
+        # full results are recorded row by row as the pages arrive
+        rows = stream_job(self, job_id)
+        if name in snapshots:
+            return refresh_rows(self, name, queries[name], snapshots[name], list(rows))
+        if name in record:
+            rows = write_ndjson(record[name], rows)
+        return list(rows)
+
+    if job_ids:
+        with ThreadPoolExecutor(max_workers=len(job_ids)) as executor:
+            futures = {name: executor.submit(fetch, name, job_id) for name, job_id in job_ids.items()}
+            for name, future in futures.items():
+                rows = future.result()
+                if self.snapshot_dir:
+                    save_snapshot(self, queries[name], rows)
+                results[name] = rows
+
+    # rows that came from (or were refreshed in) a snapshot are recorded once they are complete
+    for name in record:
+        if name not in job_ids or name in snapshots:
+            for _ in write_ndjson(record[name], results[name]):
+                pass
+
+    return {name: results[name] for name in queries}
+
+
+def list_shards(self):
+    # the top level spaces, sources and home spaces, unless the config names the shards itself
+    if self.shards:
+        return self.shards
+    catalog = self.client.request('GET', 'catalog')
+    return [item['path'][0] for item in catalog['data'] if item.get('type') == 'CONTAINER']
+
+
+def shard_query(query, shard):
+    # the rows of one top level space/source. dremio renders paths as "[space, folder, name]",
+    # names are matched both bare and double quoted
+    patterns = []
+    for name in (shard, '"' + shard.replace('"', '""') + '"'):
+        pattern = '[' + name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + ',%'
+        patterns.append('"path" like \'' + pattern.replace("'", "''") + '\' escape \'\\\'')
+    return f'select * from ({query}) shard where {" or ".join(patterns)}'
+
+
+def run_sharded(self, queries, refresh=False, record=None):
+    # the same as run_queries with every query split into one job per top level space/source.
+    # at most shard_concurrency jobs run at once so the coordinator isn't swamped, a failed
+    # shard is retried on its own and the rows come back in shard order
+    record = record or {}
+    shards = list_shards(self)
+    print(f'{datetime.now()} - extracting {len(queries)} queries from {len(shards)} shards')
+    self.metrics.count('shards', len(shards))
+
+    def run_shard(name, shard):
+        attempt = 0
+        while True:
+            try:
+                return run_queries(self, {name: shard_query(queries[name], shard)}, refresh)[name]
+            except DremioError as e:
+                if attempt >= self.shard_retries:
+                    raise DremioError(f'{name} shard {shard} failed after {attempt + 1} attempts: {e}')
+                print(f'{datetime.now()} - {name} shard {shard} failed, retrying: {e}')
+                self.metrics.count('shard_retries')
+                self.client.sleep_backoff(attempt)
+                attempt += 1
+
+    units = [(name, shard) for name in queries for shard in shards]
+    executor = ThreadPoolExecutor(max_workers=self.shard_concurrency)
+    try:
+        shard_rows = list(executor.map(lambda unit: run_shard(*unit), units))
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+    results = {name: [] for name in queries}
+    for (name, _), rows in zip(units, shard_rows):
+        results[name].extend(rows)
+
+    for name in record:
+        for _ in write_ndjson(record[name], results[name]):
+            pass
+
+    return results
+
+
+def project_query(query, columns):
+    # only the given columns of a catalog query
+    return 'select ' + ', '.join(f'"{column}"' for column in dict.fromkeys(columns)) + f' from ({query}) catalog'
+
+
+def fetch_paths(self, query, paths, columns=None):
+    # rows of query for the given paths, definition_batch_size paths per job with at most
+    # definition_concurrency jobs at once
+    size = self.definition_batch_size
+    batches = [paths[x:x + size] for x in range(0, len(paths), size)]
+    select = ', '.join(f'"{column}"' for column in columns) if columns else '*'
+
+    def fetch(batch):
+        in_paths = ', '.join("'" + path.replace("'", "''") + "'" for path in batch)
+        return execute_query(self, f'select {select} from ({query}) paths where "path" in ({in_paths})')
+
+    executor = ThreadPoolExecutor(max_workers=self.definition_concurrency)
+    try:
+        return [row for rows in executor.map(fetch, batches) for row in rows]
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def fetch_definitions(self, views):
+    # sql_definition of the views that become models. views dropped from dremio since they were listed are skipped
+    views = list(views)
+    rows = fetch_paths(self, self.view_query, [view['path'] for view in views], ['path', 'sql_definition'])
+    definitions = {row['path']: row['sql_definition'] for row in rows}
+
+    fetched = []
+    for view in views:
+        if view['path'] not in definitions:
+            print(f'{datetime.now()} - no definition for view {view["path"]}, skipped')
+            continue
+        fetched.append(dict(view, sql_definition=definitions[view['path']]))
+    self.metrics.count('definitions_fetched', len(fetched))
+    return fetched
+
+
+def index_columns(rows):
+    # {dotted dataset path: [(column, data type)]} in column order. information_schema names a dataset by its
+    # unquoted schema and table name, the same as DatasetPath.unquoted
+    index = {}
+    for row in rows:
+        key = row['TABLE_SCHEMA'] + '.' + row['TABLE_NAME']
+        index.setdefault(key, []).append((row['ORDINAL_POSITION'], row['COLUMN_NAME'], row['DATA_TYPE']))
+    return {key: [(name, data_type) for _, name, data_type in sorted(columns, key=lambda column: column[0])]
+            for key, columns in index.items()}
+
+
+def get_columns(self, record=False):
+    # every column in one bulk job, streamed page by page into the index instead of kept as rows
+    rows = execute_query_stream(self, self.column_query)
+    if record and self.local_columns:
+        rows = write_ndjson(self.local_columns, rows)
+    self.column_index = index_columns(rows)
+    self.metrics.count('columns', sum(len(columns) for columns in self.column_index.values()))
+
+
+def split_dataset_name(name):
+    # components of a dotted dataset name such as Space."folder.name".view
+    return tuple(quoted.replace('""', '"') if quoted else bare
+                 for quoted, bare in re.findall(r'"((?:[^"]|"")*)"|([^."]+)', name))
+
+
+def reflection_fields(value):
+    # reflection column lists come as "a, b" strings (or lists), measures and dimensions
+    # can carry their computations or date granularity in brackets: "amount (SUM, COUNT)"
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = re.split(r',(?![^()\[\]]*[)\]])', value.strip().strip('[]'))
+    fields = []
+    for item in value:
+        match = re.fullmatch(r'\s*"?(.*?)"?\s*(?:[(\[](.*)[)\]])?\s*', str(item))
+        if match and match.group(1):
+            fields.append((match.group(1), (match.group(2) or '').strip()))
+    return fields
+
+
+def index_reflections(rows):
+    # {dotted dataset path: [reflection row]}, disabled and external reflections have no dbt equivalent
+    index = {}
+    skipped = 0
+    for row in rows:
+        if row.get('is_enabled') is False or str(row.get('is_enabled')).lower() == 'false' \
+                or row.get('external_reflection'):
+            skipped += 1
+            continue
+        key = '.'.join(split_dataset_name(row['dataset_name']))
+        index.setdefault(key, []).append(row)
+    return index, skipped
+
+
+def get_reflections(self, record=False):
+    rows = execute_query_stream(self, self.reflection_query)
+    if record and self.local_reflections:
+        rows = write_ndjson(self.local_reflections, rows)
+    self.reflection_index, skipped = index_reflections(rows)
+    self.metrics.count('reflections', sum(len(rows) for rows in self.reflection_index.values()))
+    if skipped:
+        print(f'{datetime.now()} - {skipped} disabled or external reflections skipped')
+
+
+@instrumented('catalog')
+def get_catalog(self, refresh=False, record=False, lineage=False):
+    # the column and reflection harvests run next to the catalog queries
+    executor = ThreadPoolExecutor(max_workers=2)
+    harvests = []
+    if self.columns:
+        harvests.append(executor.submit(get_columns, self, record))
+    if self.reflections:
+        harvests.append(executor.submit(get_reflections, self, record))
+    try:
+        get_datasets(self, refresh, record, lineage)
+        for harvest in harvests:
+            harvest.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def get_datasets(self, refresh=False, record=False, lineage=False):
+    # recording writes the full catalogs to the local json files for replay in local mode
+    record_files = {'tables': self.local_tables, 'views': self.local_views} if record else None
+    run = run_sharded if self.shard else run_queries
+
+    # the full catalogs are only used for paths and schemas, with projection they leave the sql
+    # definitions (and every other column) behind. the tag is only kept for snapshots and the lineage
+    # graph to find edited datasets with. recorded catalogs keep whole rows for replay
+    project = self.projection and not record
+    tag = [self.tag_column] if self.snapshot_dir or lineage else []
+    table_query = self.table_query
+    view_query = self.view_query
+    if project:
+        table_query = project_query(self.table_query, ['path'] + tag)
+        view_query = project_query(self.view_query, ['path', 'sql_context'] + tag)
+
+    if self.client_filter:
+        # fetch each catalog once and filter the rows here instead of running the filtered queries.
+        # without a view_path_filter every view becomes a model and the definitions come with the catalog
+        lazy = project and build_path_filter(self.view_path_filter) is not None
+        results = run(self, {
+            'tables': table_query,
+            'views': view_query if lazy else self.view_query
+        }, refresh, record_files)
+        self.tables = results['tables']
+        self.views = results['views']
+        self.filtered_views = filter_rows(self.views, self.view_path_filter)
+        if lazy:
+            self.filtered_views = fetch_definitions(self, self.filtered_views)
+        return
+
+    results = run(self, {
+        'tables': table_query,
+        'views': view_query,
+        'filtered_views': f'{self.view_query} {self.view_filter}'
+    }, refresh, record_files)
+
+    self.tables = results['tables']
+    self.views = results['views']
+    self.filtered_views = results['filtered_views']
+
+
+def build_path_filter(patterns):
+    # one pattern per line, any match keeps the row. a pattern is a glob on the dotted path
+    # (space.folder.name), prefix with space: or name: to match only that part of the path
+    # and with re: to use a regex instead of a glob. matching is case-insensitive like dremio
+    matchers = []
+    for pattern in patterns.splitlines():
+        pattern = pattern.strip()
+        if not pattern:
+            continue
+
+        field = 'path'
+        for prefix in ('path:', 'space:', 'name:'):
+            if pattern.startswith(prefix):
+                field = prefix[:-1]
+                pattern = pattern[len(prefix):]
+
+        if pattern.startswith('re:'):
+            regex = re.compile(pattern[3:], re.IGNORECASE)
+        else:
+            regex = re.compile(fnmatch.translate(pattern), re.IGNORECASE)
+        matchers.append((field, regex))
+
+    if not matchers:
+        return None
+
+    def path_filter(row):
+        path = parse_path(row['path'])
+        values = {'path': path.unquoted, 'space': path.components[0], 'name': path.alias}
+        return any(regex.fullmatch(values[field]) for field, regex in matchers)
 
+    return path_filter
 
-def get_tables(self):
-    query = self.table_query
-    tables = execute_query(self, query)
 
-    self.tables = tables
+def filter_rows(rows, patterns):
+    # keeps every row when no patterns are set, the same as an empty view_filter
+    path_filter = build_path_filter(patterns)
+    if path_filter is None:
+        return rows
+    return [row for row in rows if path_filter(row)]
 
 
-def get_filtered_tables(self):
-    query = f'{self.table_query} {self.table_filter}'
-    tables = execute_query(self, query)
+def open_ndjson(file_name, mode='r'):
+    # ndjson files are compressed according to their extension, .gz (gzip) or .zst (zstandard)
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, mode + 't', encoding='utf-8')
+    elif file_name.endswith('.zst'):
+        if zstandard is None:
+            raise DremioError(f'zstandard is required to read or write {file_name}, pip install zstandard')
+        if mode == 'w':
+            stream = zstandard.ZstdCompressor().stream_writer(open(file_name, 'wb'))
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(open(file_name, 'rb'))
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    else:
+        return open(file_name, mode, encoding='utf-8')
+
+
+def write_ndjson(file_name, rows):
+    # passes the rows through while writing each one out, so rows are saved as they stream in
+    with open_ndjson(file_name, 'w') as file:
+        for row in rows:
+            file.write(json.dumps(row) + '\n')
+            yield row
+
+
+class NDJSONRows:
+    # rows of an ndjson file, read lazily every time they are iterated so a large
+    # catalog dump never has to be held in memory. the time spent reading and decoding
+    # them, not the time of the caller going through them, adds up in the catalog_read timer
+    def __init__(self, file_name, row_filter=None, metrics=None):
+        self.file_name = file_name
+        self.row_filter = row_filter
+        self.metrics = metrics
+
+    def __iter__(self):
+        seconds = 0.0
+        start = perf_counter()
+        try:
+            with open_ndjson(self.file_name) as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    row = json.loads(line)
+                    if self.row_filter is None or self.row_filter(row):
+                        seconds += perf_counter() - start
+                        yield row
+                        start = perf_counter()
+            seconds += perf_counter() - start
+        finally:
+            if self.metrics is not None:
+                self.metrics.add(self.metrics.timers, 'catalog_read', seconds)
 
-    self.filtered_tables = tables
 
 def get_local_tables(self):
-    tableList = []
-    with open(self.local_tables) as f:
-        for jsonObj in f:
-            tableDict = json.loads(jsonObj)
-            tableList.append(tableDict)
-    self.tables = tableList
-    self.filtered_tables = tableList
+    # the rows are read by the stages going through them, there is no catalog stage in local mode
+    self.tables = NDJSONRows(self.local_tables, metrics=self.metrics)
+
 
 def get_local_views(self):
-    viewList = []
-    with open(self.local_views) as f:
-        for jsonObj in f:
-            viewDict = json.loads(jsonObj)
-            viewList.append(viewDict)
-    self.views = viewList
-    self.filtered_views = viewList
+    self.views = NDJSONRows(self.local_views, metrics=self.metrics)
+    if self.client_filter:
+        self.filtered_views = NDJSONRows(self.local_views, build_path_filter(self.view_path_filter), self.metrics)
+    else:
+        self.filtered_views = self.views
+
+
+@instrumented('catalog_columns')
+def get_local_columns(self):
+    if self.columns and self.local_columns:
+        self.column_index = index_columns(NDJSONRows(self.local_columns, metrics=self.metrics))
+
+
+@instrumented('catalog_reflections')
+def get_local_reflections(self):
+    if self.reflections and self.local_reflections:
+        self.reflection_index, _ = index_reflections(NDJSONRows(self.local_reflections, metrics=self.metrics))
 
 
 def contains_non_alphanumeric(input_string):
@@ -282,24 +954,284 @@ def contains_non_alphanumeric(input_string):
     return bool(match)
 
 
-def build_parent_list(parent_path):
-    # save the quoted path and unquoted path
-    path_list = ast.literal_eval('[' + ', '.join(['"' + item.strip() + '"' for item in parent_path[1:-1].split(',')]) + ']')
-    quoted_path_list = []
-    for path in path_list:
-        if contains_non_alphanumeric(path):
-            quoted_path_list.append(f'"{path}"')
-        else:
-            quoted_path_list.append(path)
-    quoted_path = ".".join(quoted_path_list)
-    unquoted_path = ".".join(path_list)
+class ModelRewriter:
+    # turns a view definition into a dbt model from a single tokenization. table references are found by
+    # token position, spliced out for ref()/source() and the same token stream is reindented by sqlparse.
+    # backtick quoted identifiers are unquoted, or double quoted when reserved or non alphanumeric
+
+    # keywords that end the table list of a from clause, a comma after a join condition is still a table
+    from_clause_end = frozenset({'WHERE', 'GROUP BY', 'HAVING', 'ORDER BY', 'LIMIT', 'OFFSET', 'FETCH', 'UNION',
+                                 'UNION ALL', 'EXCEPT', 'INTERSECT', 'MINUS', 'WINDOW', 'QUALIFY'})
+
+    # functions that take a FROM inside their parentheses, extract(year from x)
+    from_functions = frozenset({'EXTRACT', 'SUBSTRING', 'TRIM', 'OVERLAY', 'POSITION'})
+
+    # keywords that can't start a table name. sqlparse lexes plenty of common table names (events, data,
+    # user, source, raw, ...) as keywords, anything else where a table or cte name is expected is a name
+    structural = frozenset({'SELECT', 'LATERAL', 'TABLE', 'VALUES', 'UNNEST', 'WITH', 'RECURSIVE'})
+
+    def __init__(self, reserved):
+        self.reserved = frozenset(word.lower() for word in reserved)
+        self.format_options = sqlparse.formatter.validate_options({'reindent': True})
+
+    def quote_identifier(self, identifier):
+        if identifier.lower() in self.reserved or contains_non_alphanumeric(identifier):
+            return '"' + identifier.replace('"', '""') + '"'
+        return identifier
+
+    @staticmethod
+    def unquote(value):
+        if len(value) > 1 and value[0] == value[-1] and value[0] in '`"':
+            return value[1:-1].replace(value[0] * 2, value[0])
+        return value
+
+    def tokenize(self, sql):
+        return list(sqlparse.lexer.tokenize(sql))
+
+    def is_name(self, ttype, value):
+        # a name token, or a keyword standing where a name is expected
+        if ttype in T.Name or ttype in T.String.Symbol:
+            return True
+        return ttype in T.Keyword and ttype not in T.Keyword.DML and ttype not in T.Keyword.CTE \
+            and value.upper() not in self.structural
+
+    def read_name(self, tokens, start):
+        # a dotted name starting at start, returns the end position and its unquoted parts
+        parts = []
+        position = start
+        while position < len(tokens):
+            ttype, value = tokens[position]
+            if self.is_name(ttype, value) or (parts and ttype in T.Keyword):
+                parts.append(self.unquote(value))
+                position += 1
+            else:
+                break
+            if position + 1 < len(tokens) and tokens[position][1] == '.':
+                position += 1
+            else:
+                break
+
+        # a name followed by ( is a table function, not a table
+        if position < len(tokens) and tokens[position][1] == '(':
+            return start, []
+        return position, parts
+
+    def table_references(self, tokens):
+        # [(start, end, table name)] for every table read after FROM, JOIN or a comma in a from clause.
+        # common table expressions and subqueries are skipped, names are the dotted unquoted parts
+        references = []
+        cte_names = set()
+        with_depths = set()
+        from_depths = set()
+        function_depths = set()
+        depth = 0
+        expect_table = False
+        previous = (None, None)
+        position = 0
+
+        while position < len(tokens):
+            ttype, value = tokens[position]
+            if ttype in T.Whitespace or ttype in T.Comment:
+                position += 1
+                continue
+
+            keyword = ' '.join(value.upper().split()) if ttype in T.Keyword else None
+
+            if expect_table:
+                expect_table = False
+                end, parts = self.read_name(tokens, position)
+                if parts:
+                    if len(parts) > 1 or parts[0].lower() not in cte_names:
+                        references.append((position, end, '.'.join(parts)))
+                    previous = tokens[end - 1]
+                    position = end
+                    continue
+
+            if depth in with_depths and (previous[0] in T.Keyword.CTE or previous[1] in (',', 'RECURSIVE')) \
+                    and self.is_name(ttype, value):
+                cte_names.add(self.unquote(value).lower())
+            elif value == '(':
+                depth += 1
+                if previous[0] in T.Name or (previous[0] in T.Keyword and previous[1].upper() in self.from_functions):
+                    function_depths.add(depth)
+            elif value == ')':
+                from_depths.discard(depth)
+                with_depths.discard(depth)
+                function_depths.discard(depth)
+                depth -= 1
+            elif value == ',' and depth in from_depths:
+                expect_table = True
+            elif ttype in T.Keyword.CTE:
+                with_depths.add(depth)
+            elif ttype in T.DML:
+                with_depths.discard(depth)
+                from_depths.discard(depth)
+            elif keyword is not None and depth not in function_depths:
+                if keyword == 'FROM' and previous[1] == 'DISTINCT':
+                    # a IS [NOT] DISTINCT FROM b compares values
+                    pass
+                elif keyword == 'FROM' or keyword.endswith('JOIN'):
+                    from_depths.add(depth)
+                    expect_table = True
+                elif keyword in self.from_clause_end:
+                    from_depths.discard(depth)
+
+            previous = (ttype, keyword or value)
+            position += 1
+
+        return references
+
+    def splice(self, tokens, references, replacements):
+        # splice the replacement in for every reference that has one and fix up backtick identifiers
+        starts = {start: (end, name) for start, end, name in references if name in replacements}
+        rewritten = []
+        position = 0
+        while position < len(tokens):
+            if position in starts:
+                end, name = starts[position]
+                rewritten.append((T.Name, replacements[name]))
+                position = end
+                continue
+
+            ttype, value = tokens[position]
+            if ttype in T.Name and value.startswith('`'):
+                value = self.quote_identifier(self.unquote(value))
+            rewritten.append((ttype, value))
+            position += 1
+        return rewritten
+
+    def format(self, tokens):
+        # same as sqlparse.format(reindent=True) without tokenizing the query again,
+        # the filters keep state between statements so every view gets a new stack
+        stack = sqlparse.formatter.build_filter_stack(sqlparse.engine.FilterStack(), self.format_options)
+        statements = []
+        for statement in StatementSplitter().process(tokens):
+            grouping.group(statement)
+            for statement_filter in stack.stmtprocess:
+                statement_filter.process(statement)
+            statements.append(SerializerUnicode.process(statement))
+        return ''.join(statements)
+
+    def render(self, tokens, references, replacements):
+        return self.format(self.splice(tokens, references, replacements))
+
+
+class DatasetPath:
+    # parsed form of a dremio path string such as "[space, folder, view]", built once per path by parse_path
+    __slots__ = ('components', 'quoted', 'unquoted', 'model_name', 'alias', 'source_name')
+
+    def __init__(self, components):
+        self.components = components
+        self.quoted = '.'.join('"' + item.replace('"', '""') + '"' if contains_non_alphanumeric(item) else item
+                               for item in components)
+        self.unquoted = '.'.join(components)
+
+        # models are named after the whole path, aliased to the dataset name and
+        # tables are grouped into sources named after their parent path
+        self.model_name = '_'.join(components).replace('"', '').replace('.', '_')
+        self.alias = components[-1]
+        self.source_name = '_'.join(components[:-1]).replace('"', '').replace('.', '_')
+
+    @property
+    def schema(self):
+        return self.components[:-1]
+
+
+@lru_cache(maxsize=None)
+def parse_path(path):
+    # split on the commas outside of double quotes so quoted names can hold commas
+    items = re.split(r',(?=(?:(?:[^"]*"){2})*[^"]*$)', path.strip()[1:-1])
+    components = []
+    for item in items:
+        item = item.strip()
+        if len(item) > 1 and item.startswith('"') and item.endswith('"'):
+            item = item[1:-1].replace('""', '"')
+        components.append(item)
+    return DatasetPath(tuple(components))
+
+
+def schema_file(path, split):
+    # schema.yml a dataset is described in, relative to the project: one for the whole project,
+    # one per top level space or source, or one per folder next to the models of that folder
+    if split == 'space':
+        return 'models/' + path.components[0] + '/schema.yml'
+    if split == 'folder':
+        return 'models/' + '/'.join(path.schema) + '/schema.yml'
+    return 'models/schema.yml'
+
+
+@instrumented('build_yaml')
+def build_yaml(self):
+    # sources, models and the project schema config are put together in one pass over the catalog
+    # and every yaml file is written once
+    project_root = self.output + '/' + self.project_name + '/'
+    split = self.schema_split or None
+    documents = {}
+    sources = {}
+    schemas = {}
+
+    def document(path):
+        name = schema_file(path, split)
+        if name not in documents:
+            documents[name] = {'version': 2, 'sources': [], 'models': []}
+        return documents[name]
+
+    if split is None:
+        document(None)
+
+    def add_columns(entry, path):
+        # harvested columns are joined on the dataset path
+        columns = self.column_index.get(path.unquoted)
+        if columns:
+            entry['columns'] = [{'name': name, 'data_type': data_type} for name, data_type in columns]
+        return entry
 
-    # Create list of untouched path and quoted path
-    return {'unquoted': unquoted_path,
-        'quoted': quoted_path}
+    for table in self.tables:
+        path = parse_path(table['path'])
+        name = path.source_name
 
+        if name not in sources:
+            sources[name] = {
+                "name": name,
+                "database": path.components[0],
+                "schema": '"' + '"."'.join(path.components) + '"',
+                "tables": []
+            }
+            document(path)['sources'].append(sources[name])
+        sources[name]['tables'].append(add_columns({'name': path.alias}, path))
 
-def build_project_yaml(self):
+    for view in self.views:
+        path = parse_path(view['path'])
+        schemas.setdefault(path.schema, None)
+
+        # alias should be the last item in the list (view name)
+        document(path)['models'].append(add_columns({"name": path.model_name,
+                                                     "config": [{"alias": path.alias}]}, path))
+
+    # the round trip dumper is only needed to keep the comments in dbt_project.yml,
+    # the safe one writes the same yaml for plain dicts a lot faster
+    yaml = ruamel.yaml.YAML(typ='safe')
+    yaml.default_flow_style = False
+    yaml.representer.sort_base_mapping_type_on_output = False
+    for name, data in documents.items():
+        if split is not None:
+            data = {key: value for key, value in data.items() if value}
+        makedirs(os.path.dirname(project_root + name), exist_ok=True)
+        with self.metrics.timer('yaml_dump'), open(project_root + name, 'w') as file:
+            yaml.dump(data, file)
+
+    # schema files of an earlier export that this one didn't write would define sources and models twice,
+    # exports from before the manifest recorded them always wrote models/schema.yml
+    for name in read_manifest(self).get('schema_files', ['models/schema.yml']):
+        if name not in documents and os.path.exists(project_root + name):
+            print(f'{datetime.now()} - removing schema file {name}')
+            os.remove(project_root + name)
+    write_manifest(self, schema_files=sorted(documents))
+
+    build_project_yaml(self, schemas)
+
+
+def build_project_yaml(self, schemas):
 
     def create_schema(schema):
         return {'+schema': schema}
@@ -311,9 +1243,7 @@ def build_project_yaml(self):
         current_dict.update(create_schema('.'.join(keys)))
 
     data = {}
-    for item in self.schemas:
-        # keys = re.findall(r'"(.*?)"', item)
-        keys = item
+    for keys in schemas:
         create_nested_dicts(data, keys)
 
     # Load the existing YAML file
@@ -329,179 +1259,723 @@ def build_project_yaml(self):
     existing_data.update(models)
 
     # Write the updated data back to the YAML file while maintaining formatting
-    with open(file_path, 'w') as file:
+    with self.metrics.timer('yaml_dump'), open(file_path, 'w') as file:
         yaml.dump(existing_data, file)
 
 
-def build_source_yaml(self):
-    # new file path for schema.yaml
-    file_path = self.output + '/' + self.project_name + '/models/schema.yml'
-
-    # define base schema
-    data = {'version': 2,
-            'sources': []
-            }
-
-    # define table list
-    table_list = []
-
-    # generate the schema
-    for table in self.tables:
-
-        # Convert path to a list
-        path_list = ast.literal_eval(
-            '[' + ', '.join(['"' + item.strip() + '"' for item in table['path'][1:-1].split(',')]) + ']')
-
-        table_list.append(path_list)
-
-    path_dict = {}
-
-    for path in table_list:
-
-        name = '_'.join(path[:-1]).replace('"', '').replace('.', '_')
-        database = path[0]
-
-        if name not in path_dict:
-            path_dict[name] = {
-                "name": name,
-                "database": database,
-                "schema": '"' + '"."'.join(path) + '"',
-                "tables": []
-            }
-        path_dict[name]['tables'].append({'name': path[-1]})
-
-    for path in path_dict:
-        data['sources'].append(path_dict[path])
+def build_source_index(self):
+    # index every table and view by its unquoted path so references resolve with a dict lookup.
+    # entries keep their catalog position (tables first, then views) so the earliest match wins,
+    # the lower case index is only used when no exact match exists (dremio is case-insensitive)
+    exact = {}
+    lower = {}
+    position = 0
+
+    for table_type, datasets in (('table', self.tables), ('view', self.views)):
+        for dataset in datasets:
+            source = parse_path(dataset['path'])
+            entry = (position, {'source': source, 'type': table_type})
+            exact.setdefault(source.unquoted, entry)
+            lower.setdefault(source.unquoted.lower(), entry)
+            position += 1
+
+    return {'exact': exact, 'lower': lower}
+
+
+def resolve_source(source_index, query_table, context_table=None):
+    # look up the referenced table and the context qualified table, earliest catalog entry wins
+    for index, key in (('exact', lambda name: name), ('lower', str.lower)):
+        matches = [source_index[index][key(name)] for name in (context_table, query_table)
+                   if name is not None and key(name) in source_index[index]]
+        if matches:
+            return min(matches, key=lambda match: match[0])[1]
+    return None
+
+
+def resolve_references(view, query_tables, source_index):
+    # match each table the view reads from against the catalog, {query_table: source or None}
+    resolved = {}
+    for query_table in query_tables:
+        # Check if the context should be used, dremio always defaults to context source.
+        if view['sql_context']:
+            context_table = view['sql_context'] + "." + query_table
+        else:
+            context_table = None
 
-    # Create the new yaml file
-    yaml = ruamel.yaml.YAML()
-    with open(file_path, 'w') as file:
-        yaml.dump(data, file)
+        resolved[query_table] = resolve_source(source_index, query_table, context_table)
+    return resolved
 
 
-def build_schema_models_yaml(self):
-    # open existing yaml
-    file_path = self.output + '/' + self.project_name + '/models/schema.yml'
+def dependency_list(resolved):
+    # the resolved references of a view in a stable, json friendly form for the manifest
+    return [[query_table, source['type'], source['source'].quoted] if source else [query_table, None, None]
+            for query_table, source in resolved.items()]
 
-    # define base model
-    model_data = {'models': []}
 
-    view_list = []
+def definition_hash(view):
+    return hashlib.sha256(json.dumps([view['sql_definition'], view['sql_context']]).encode()).hexdigest()
 
-    for view in self.views:
-        # Convert path to a list
-        path_list = ast.literal_eval(
-            '[' + ', '.join(['"' + item.strip() + '"' for item in view['path'][1:-1].split(',')]) + ']')
 
-        # join list using _ and replace any quotes
-        model_name = '_'.join(path_list).replace('"', '').replace('.', '_')
+def model_hash(source_hash, dependencies):
+    return hashlib.sha256(json.dumps([source_hash, dependencies]).encode()).hexdigest()
 
-        # alias should be the last item in the list (view name)
-        alias = path_list[-1]
 
-        model = { "name": model_name,
-                  "config": [{"alias": alias}]
-                  }
+def model_replacements(view, tables, source_index, model_name):
+    # the ref()/source() each referenced table is swapped for
+    resolved = resolve_references(view, tables, source_index)
+    replacements = {}
 
-        model_data['models'].append(model)
+    for query_table, source_table in resolved.items():
+        if source_table is not None:
+            source = source_table['source']
+            table_type = source_table['type']
 
-    # open yaml file
-    yaml = ruamel.yaml.YAML()
-    with open(file_path, 'r') as file:
-        data = yaml.load(file)
+            if table_type == 'view':
+                replacements[query_table] = "{{ ref('" + source.model_name + "') }}"
+            elif table_type == 'table':
+                replacements[query_table] = "{{ source('" + source.source_name + "', '" + source.alias + "') }}"
+            else:
+                print(f'{query_table} failed to match in {model_name}')
 
-    # update the yaml data
-    data.update(model_data)
+    return resolved, replacements
 
-    # write the yaml file
-    with open(file_path, 'w') as file:
-        yaml.dump(data, file)
 
-def build_model(self):
-    # build list of sources
-    source_list = []
+def replacements_hash(replacements):
+    return hashlib.sha256(json.dumps(replacements, sort_keys=True).encode()).hexdigest()
+
+
+def render_model(view, source_index, rewriter, models_root):
+    # parse, rewrite and format a single view, returns where the model goes, its sql and what it depends on
+    path = parse_path(view['path'])
+    model_path = models_root + "/".join(path.schema)
+    model_name = model_path + "/" + path.model_name + '.sql'
+
+    start = perf_counter()
+    tokens = rewriter.tokenize(view['sql_definition'])
+    references = rewriter.table_references(tokens)
+    tables = list(dict.fromkeys(name for _, _, name in references))
+    resolved, replacements = model_replacements(view, tables, source_index, model_name)
+    parsed = perf_counter()
+
+    # swap in the dbt references and format the sql from the same tokens
+    rewritten = rewriter.splice(tokens, references, replacements)
+    spliced = perf_counter()
+    final_sql = rewriter.format(rewritten)
+    formatted = perf_counter()
+
+    return {'path': model_path,
+            'file': model_name,
+            'sql': final_sql,
+            'tables': tables,
+            'replacements': replacements_hash(replacements),
+            'dependencies': dependency_list(resolved),
+            'timings': {'view_parse': parsed - start,
+                        'view_rewrite': spliced - parsed,
+                        'view_format': formatted - spliced}}
+
+
+def cached_model(view, cached, source_index, models_root):
+    # rebuild the model from a parse cache entry, None when its references now resolve differently
+    tables, cached_replacements, final_sql = cached
+    path = parse_path(view['path'])
+    model_path = models_root + "/".join(path.schema)
+    model_name = model_path + "/" + path.model_name + '.sql'
+
+    resolved, replacements = model_replacements(view, tables, source_index, model_name)
+    if replacements_hash(replacements) != cached_replacements:
+        return None
+
+    return {'path': model_path,
+            'file': model_name,
+            'sql': final_sql,
+            'tables': tables,
+            'replacements': cached_replacements,
+            'dependencies': dependency_list(resolved),
+            'timings': {}}
+
+
+def init_model_worker(source_index, rewriter, models_root):
+    # the source index is handed to each worker process once instead of with every view
+    global model_worker_context
+    model_worker_context = (source_index, rewriter, models_root)
+
+
+def render_model_worker(view, context=None):
+    # errors are returned instead of raised so one bad view doesn't stop the export.
+    # serial renders pass their context along as targets can run side by side in threads
+    try:
+        return view['path'], render_model(view, *(context or model_worker_context)), None
+    except Exception as e:
+        return view['path'], None, f'{type(e).__name__}: {e}'
+
+
+def manifest_file(self):
+    return self.output + '/' + self.project_name + '/dremio_manifest.json'
+
+
+def read_manifest(self):
+    # the views and schema files of the last export, empty on the first run
+    if not os.path.exists(manifest_file(self)):
+        return {}
+    with open(manifest_file(self)) as file:
+        manifest = json.load(file)
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest
+
+
+def load_manifest(self):
+    # {view path: {'model', 'source_hash', 'hash', 'tables'}} from the last export
+    return read_manifest(self).get('views', {})
+
+
+def write_manifest(self, **entries):
+    manifest = read_manifest(self)
+    manifest.update(entries, version=MANIFEST_VERSION)
+    with open(manifest_file(self), 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+
+
+class ParseCache:
+    # sqlite cache of parsed view definitions keyed by the hash of sql_definition and sql_context. an entry holds
+    # the tables the view reads and the formatted model for the ref()/source() replacements it was rendered with.
+    # least recently used entries are evicted once the cache grows past max_bytes and a version change empties it
+    def __init__(self, file_name, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = {}
+        self.file_name = file_name
+        self.users = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute('create table if not exists meta (key text primary key, value text)')
+        self.connection.execute('create table if not exists entries (key text primary key, tables text, '
+                                'replacements text, sql text, size integer, used real)')
+        self.connection.execute('create index if not exists entries_used on entries (used)')
+
+        version = self.connection.execute("select value from meta where key = 'version'").fetchone()
+        if version is None or version[0] != PARSE_CACHE_VERSION:
+            self.connection.execute('delete from entries')
+            self.connection.execute("insert or replace into meta values ('version', ?)", (PARSE_CACHE_VERSION,))
+        self.connection.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('select tables, replacements, sql from entries where key = ?',
+                                          (key,)).fetchone()
+            if row is None:
+                return None
+            self.used[key] = time()
+        return json.loads(row[0]), row[1], row[2]
+
+    def put(self, key, tables, replacements, sql):
+        tables = json.dumps(tables)
+        with self.lock:
+            self.connection.execute('insert or replace into entries values (?, ?, ?, ?, ?, ?)',
+                                    (key, tables, replacements, sql, len(tables) + len(sql), time()))
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def close(self):
+        with self.lock:
+            self.flush_locked()
+            self.connection.close()
+
+    def flush_locked(self):
+        # last used times are written once at the end of an export instead of on every hit
+        self.connection.executemany('update entries set used = ? where key = ?',
+                                    [(used, key) for key, used in self.used.items()])
+        self.used = {}
+
+        size = self.connection.execute('select coalesce(sum(size), 0) from entries').fetchone()[0]
+        if size > self.max_bytes:
+            evict = []
+            for key, entry_size in self.connection.execute('select key, size from entries order by used'):
+                if size <= self.max_bytes:
+                    break
+                evict.append((key,))
+                size -= entry_size
+            self.connection.executemany('delete from entries where key = ?', evict)
+
+        self.connection.commit()
+
+
+# parse caches open in this process by file, targets exporting side by side with the same
+# parse_cache_file share one connection
+parse_caches = {}
+parse_caches_lock = threading.Lock()
+
+
+def open_parse_cache(self):
+    if not self.parse_cache:
+        return None
+    file_name = os.path.abspath(self.parse_cache_file or os.path.join(self.output, '.dremio_parse_cache.sqlite'))
+    with parse_caches_lock:
+        cache = parse_caches.get(file_name)
+        if cache is None:
+            makedirs(os.path.dirname(file_name), exist_ok=True)
+            cache = parse_caches[file_name] = ParseCache(file_name, self.parse_cache_size_mb * 1024 * 1024)
+        cache.users += 1
+    return cache
+
+
+def close_parse_cache(cache):
+    # the last target using a cache closes it, the others write their last used times
+    with parse_caches_lock:
+        cache.users -= 1
+        if cache.users:
+            cache.flush()
+            return
+        del parse_caches[cache.file_name]
+    cache.close()
+
+
+def write_model(model):
+    # create the new directories as needed
+    is_exist = os.path.exists(model['path'])
+    if not is_exist:
+        makedirs(model['path'])
+
+    # leave the file and its mtime alone when the model hasn't changed
+    if os.path.exists(model['file']):
+        with open(model['file']) as file:
+            if file.read() == model['sql']:
+                return
+
+    # write the new model file
+    with open(model['file'], "w") as file:
+        file.write(model['sql'])
+
+
+def view_tables(view, source_hash, previous, parse_cache, rewriter):
+    # the tables a view reads, taken from the manifest or the parse cache while its definition is unchanged,
+    # otherwise found by tokenizing it (formatting, the expensive part of a render, is skipped)
+    entry = previous.get(view['path'])
+    if entry and entry['source_hash'] == source_hash:
+        return entry['tables']
+    cached = parse_cache.get(source_hash) if parse_cache is not None else None
+    if cached is not None:
+        return cached[0]
+    references = rewriter.table_references(rewriter.tokenize(view['sql_definition']))
+    return list(dict.fromkeys(name for _, _, name in references))
+
+
+@instrumented('lineage')
+def build_lineage(self, source_index, rewriter, previous, parse_cache):
+    # dependency graph of the tables and views, nodes are named by their dotted path. views that aren't
+    # exported are in the graph too so selections and the graph follow dependencies through them, only
+    # exported views are in 'views'. parents are the datasets a view reads from, references that don't
+    # resolve are left out
+    nodes = {}
+    parents = {}
+    children = {}
+    views = {}
 
     for table in self.tables:
-        source_list.append({'source': build_parent_list(table['path']),
-                            'type': 'table'})
-
-    for view in self.views:
-        source_list.append({'source': build_parent_list(view['path']),
-                            'type': 'view'})
-        path_list = ast.literal_eval(
-            '[' + ', '.join(['"' + item.strip() + '"' for item in view['path'][1:-1].split(',')]) + ']')
-        schema = path_list[0:-1]
-        if schema not in self.schemas:
-            self.schemas.append(schema)
+        path = parse_path(table['path'])
+        nodes.setdefault(path.unquoted, (path, 'table'))
+
+    exported = list(self.filtered_views)
+    exported_paths = {view['path'] for view in exported}
+    others = [view for view in self.views if view['path'] not in exported_paths]
+
+    # projected catalogs leave the definitions of views that aren't exported behind. the tables they
+    # read are kept in the manifest with their tag, only views added or edited since are fetched
+    tag = self.tag_column
+    manifest = read_manifest(self).get('lineage', {})
+    cached = {view['path']: manifest[view['path']]['tables'] for view in others
+              if view.get(tag) is not None and manifest.get(view['path'], {}).get('tag') == view[tag]}
+    missing = [view for view in others if 'sql_definition' not in view and view['path'] not in cached]
+    if missing and not self.local:
+        fetched = {view['path']: view for view in fetch_definitions(self, missing)}
+        others = [fetched.get(view['path'], view) for view in others]
+
+    lineage = {}
+    for view in exported + others:
+        path = parse_path(view['path'])
+        nodes[path.unquoted] = (path, 'view')
+        if view['path'] in exported_paths:
+            views[path.unquoted] = view['path']
+        view_parents = parents.setdefault(path.unquoted, set())
+        if view['path'] in cached:
+            tables = cached[view['path']]
+        elif 'sql_definition' in view:
+            tables = view_tables(view, definition_hash(view), previous, parse_cache, rewriter)
+        else:
+            continue
+        if view['path'] not in exported_paths and view.get(tag) is not None:
+            lineage[view['path']] = {'tag': view[tag], 'tables': tables}
+        for source in resolve_references(view, tables, source_index).values():
+            if source is not None and source['source'].unquoted != path.unquoted:
+                view_parents.add(source['source'].unquoted)
+                children.setdefault(source['source'].unquoted, set()).add(path.unquoted)
+
+    write_manifest(self, lineage=lineage)
+    return {'nodes': nodes, 'parents': parents, 'children': children, 'views': views}
+
+
+def walk_lineage(edges, start, depth=None):
+    # the nodes reachable from start by following edges, at most depth steps when given
+    reached = set()
+    frontier = set(start)
+    steps = 0
+    while frontier and (depth is None or steps < depth):
+        frontier = {node for current in frontier for node in edges.get(current, ())} - reached
+        reached |= frontier
+        steps += 1
+    return reached
+
+
+def match_lineage(lineage, pattern):
+    # glob on the dotted path, falling back to the dataset name alone as dbt does for model names
+    regex = re.compile(fnmatch.translate(pattern), re.IGNORECASE)
+    matched = {node for node in lineage['nodes'] if regex.match(node)}
+    if not matched:
+        matched = {node for node, (path, _) in lineage['nodes'].items() if regex.match(path.alias)}
+    return matched
+
+
+def select_lineage(lineage, selectors):
+    # dbt style selectors, each one adds to the selection:
+    #   space.view      the dataset itself, globs like space.folder.* match many
+    #   +space.view     with all of its ancestors, 2+space.view only two levels up
+    #   space.view+     with all of its descendants, space.view+1 only its direct children
+    #   @space.view     its descendants and every ancestor of those
+    selected = set()
+    for selector in selectors:
+        match = re.fullmatch(r'(@)?(?:(\d*)\+)?(.+?)(?:\+(\d*))?', selector.strip())
+        at, up, pattern, down = match.groups()
+        matched = match_lineage(lineage, pattern)
+        if not matched:
+            print(f'{datetime.now()} - selector {selector} matches nothing')
+            continue
+
+        selected |= matched
+        if at:
+            descendants = matched | walk_lineage(lineage['children'], matched)
+            selected |= descendants | walk_lineage(lineage['parents'], descendants)
+            continue
+        if up is not None:
+            selected |= walk_lineage(lineage['parents'], matched, int(up) if up else None)
+        if down is not None:
+            selected |= walk_lineage(lineage['children'], matched, int(down) if down else None)
+    return selected
+
+
+def write_lineage(lineage, file_name, selected=None):
+    # graphviz for .dot files, json otherwise. a selection exports only the selected part of the graph
+    nodes = [node for node in lineage['nodes'] if selected is None or node in selected]
+    edges = [(parent, node) for node in nodes for parent in sorted(lineage['parents'].get(node, ()))
+             if selected is None or parent in selected]
+
+    makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+    with open(file_name, 'w') as file:
+        if file_name.endswith('.dot'):
+            file.write('digraph dremio {\n    rankdir=LR;\n')
+            for node in nodes:
+                shape = 'box' if lineage['nodes'][node][1] == 'table' else 'ellipse'
+                unexported = lineage['nodes'][node][1] == 'view' and node not in lineage['views']
+                style = ', style=dashed' if unexported else ''
+                file.write(f'    {json.dumps(node)} [shape={shape}{style}];\n')
+            for parent, node in edges:
+                file.write(f'    {json.dumps(parent)} -> {json.dumps(node)};\n')
+            file.write('}\n')
+        else:
+            json.dump({'nodes': [{'name': node, 'type': lineage['nodes'][node][1],
+                                  'path': list(lineage['nodes'][node][0].components),
+                                  'exported': node in lineage['views']} for node in nodes],
+                       'edges': edges}, file, indent=2)
+    print(f'{datetime.now()} - wrote lineage graph of {len(nodes)} datasets and {len(edges)} edges to {file_name}')
+
+
+@instrumented('build_model')
+def build_model(self, workers=1, incremental=False, prune=False, select=None, graph=None, mp_context=None):
+    # build the source lookup index
+    source_index = build_source_index(self)
+    rewriter = ModelRewriter(self.dremio_reserved)
+    project_root = self.output + "/" + self.project_name + "/"
+    models_root = project_root + "models/"
+
+    # an incremental export only renders views whose definition, context or resolved
+    # dependencies changed since the manifest was written, the rest keep their model file
+    previous = load_manifest(self)
+    manifest = {}
+    view_paths = set()
+    pending = []
+
+    # views already in the parse cache skip tokenizing and formatting as long as their
+    # references still resolve to the same ref()/source()
+    parse_cache = open_parse_cache(self)
+    cache_hits = 0
+
+    # with selectors only the selected views are built, the others keep their model and manifest entry
+    selected = None
+    unselected = 0
+    if select or graph:
+        lineage = build_lineage(self, source_index, rewriter, previous, parse_cache)
+        nodes = select_lineage(lineage, select) if select else None
+        if nodes is not None:
+            selected = {lineage['views'][node] for node in nodes if node in lineage['views']}
+            self.metrics.count('views_selected', len(selected))
+        if graph:
+            write_lineage(lineage, graph, nodes)
 
     for view in self.filtered_views:
-        model_path = self.output + "/" + self.project_name + "/models/" + "/".join(view['path'].split(', ')[0:-1])\
-            .replace('[', '').replace(']', '')
-        model_name = model_path + "/" + \
-                     "_".join(view['path'].split(', ')[0:-1]).replace('[', '').replace(']', '') + \
-                     "_" + view['view_name'] + '.sql'
-
-        sql_obj = Parser(view['sql_definition'])
-        new_query = sql_obj.query
-
-        for query_table in sql_obj.tables:
-            table_type = None
-            full_table = None
-            # Check if the context should be used, dremio always defaults to context source.
-            if view['sql_context']:
-                context_table = view['sql_context'] + "." + query_table
-            else:
-                context_table = None
-
-            for source_table in source_list:
-                if context_table == source_table['source']['unquoted']:
-                    full_table = source_table['source']['quoted']
-                    table_type = source_table['type']
-                    break
-                elif query_table == source_table['source']['unquoted']:
-                    full_table = source_table['source']['quoted']
-                    table_type = source_table['type']
-                    break
-
-            if full_table != None:
-                #split back into parts
-                table_parts = re.split(r'\.(?=(?:(?:[^"]*"){2})*[^"]*$)', full_table)
-
-                database = '_'.join(table_parts[:-1]).replace('"', '').replace('.', '_')
-                table = table_parts[-1]
-                dbt_ref = table.replace('"', '').replace('.', '_')
-
-
-
-                new_query = new_query.replace("`", '')
-
-                if table_type == 'view':
-                    ref = "{{ ref('" + dbt_ref + "') }}"
-                    new_query = new_query.replace(query_table, ref)
-                elif table_type == 'table':
-                    ref = "{{ source('" + database + "','" + table + "') }}"
-                    new_query = new_query.replace(query_table, ref)
-                else:
-                    print(f'{query_table} failed to match in {model_name}')
-
-                for value in self.dremio_reserved:
-                    # Create a regular expression pattern that matches the reserved word surrounded by backticks
-                    pattern = rf'`({re.escape(value)})`'
-
-                    # Replace using re.sub() with the pattern
-                    new_query = re.sub(pattern, r'"\1"', new_query)
-
-        # format sql
-        final_sql = sqlparse.format(new_query, reindent=True)
-
-        # create the new directories as needed
-        is_exist = os.path.exists(model_path)
-        if not is_exist:
-            makedirs(model_path)
-
-        # write the new model file
-        with open(model_name, "w") as file:
-            file.write(final_sql)
+        view_paths.add(view['path'])
+        entry = previous.get(view['path'])
+        if selected is not None and view['path'] not in selected:
+            unselected += 1
+            if entry:
+                manifest[view['path']] = entry
+            continue
+
+        source_hash = definition_hash(view)
+        if incremental and entry and entry['source_hash'] == source_hash \
+                and os.path.exists(project_root + entry['model']):
+            resolved = resolve_references(view, entry['tables'], source_index)
+            if model_hash(source_hash, dependency_list(resolved)) == entry['hash']:
+                manifest[view['path']] = entry
+                continue
+
+        cached = parse_cache.get(source_hash) if parse_cache is not None else None
+        model = cached_model(view, cached, source_index, models_root) if cached is not None else None
+        if model is not None:
+            cache_hits += 1
+            with self.metrics.timer('model_write'):
+                write_model(model)
+            manifest[view['path']] = {'model': os.path.relpath(model['file'], project_root),
+                                      'source_hash': source_hash,
+                                      'hash': model_hash(source_hash, model['dependencies']),
+                                      'tables': model['tables']}
+            continue
+
+        pending.append((view, source_hash))
+
+    # render the models, in worker processes when asked to. results come back in view order
+    # and files are only written from this process so the output matches a serial run
+    views = [view for view, _ in pending]
+    executor = None
+    if workers > 1 and len(views) > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_model_worker,
+                                       initargs=(source_index, rewriter, models_root), mp_context=mp_context)
+        results = executor.map(render_model_worker, views, chunksize=16)
+    else:
+        context = (source_index, rewriter, models_root)
+        results = (render_model_worker(view, context) for view in views)
+
+    failed = 0
+    try:
+        for (view_path, model, error), (_, source_hash) in zip(results, pending):
+            if error is not None:
+                failed += 1
+                print(f'{datetime.now()} - failed to build model for {view_path}: {error}')
+                # the model of the last export stays, keep tracking it so it can still be pruned
+                if view_path in previous:
+                    manifest[view_path] = previous[view_path]
+                continue
+
+            self.metrics.record_view(view_path, model['timings'])
+            with self.metrics.timer('model_write'):
+                write_model(model)
+            manifest[view_path] = {'model': os.path.relpath(model['file'], project_root),
+                                   'source_hash': source_hash,
+                                   'hash': model_hash(source_hash, model['dependencies']),
+                                   'tables': model['tables']}
+            if parse_cache is not None:
+                parse_cache.put(source_hash, model['tables'], model['replacements'], model['sql'])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if parse_cache is not None:
+            close_parse_cache(parse_cache)
+
+    # views that are gone from dremio (or no longer pass the filter) since the last export
+    for view_path, entry in previous.items():
+        if view_path in view_paths:
+            continue
+        if prune:
+            print(f'{datetime.now()} - removing model for deleted view {view_path}')
+            if os.path.exists(project_root + entry['model']):
+                os.remove(project_root + entry['model'])
+        else:
+            print(f'{datetime.now()} - view {view_path} no longer exists, model kept: {entry["model"]}')
+            manifest[view_path] = entry
+
+    write_manifest(self, views=manifest)
+
+    self.metrics.count('models_built', len(pending) - failed + cache_hits)
+    self.metrics.count('models_from_parse_cache', cache_hits)
+    self.metrics.count('models_unchanged', len(view_paths) - len(pending) - cache_hits - unselected)
+    self.metrics.count('models_failed', failed)
+    print(f'{datetime.now()} - {len(pending) - failed + cache_hits} models built ({cache_hits} from the parse cache), '
+          f'{len(view_paths) - len(pending) - cache_hits - unselected} unchanged'
+          + (f', {unselected} not selected' if selected is not None else ''))
+    if failed:
+        print(f'{datetime.now()} - {failed} views failed to build')
+
+
+def reflection_sql(reflection, dependency):
+    # a dbt-dremio reflection model on the dataset dependency points at
+    config = {'alias': reflection['reflection_name'], 'materialized': 'reflection'}
+    if str(reflection.get('type', '')).upper().startswith('AGG'):
+        config['reflection_type'] = 'aggregate'
+        dimensions = reflection_fields(reflection.get('dimensions'))
+        config['dimensions'] = [name for name, granularity in dimensions if granularity.upper() != 'DATE']
+        config['date_dimensions'] = [name for name, granularity in dimensions if granularity.upper() == 'DATE']
+        measures = reflection_fields(reflection.get('measures'))
+        config['measures'] = [name for name, _ in measures]
+        if any(computations for _, computations in measures):
+            config['computations'] = [computations for _, computations in measures]
+    else:
+        config['reflection_type'] = 'raw'
+        config['display'] = [name for name, _ in reflection_fields(reflection.get('display_columns'))]
+    config['partition_by'] = [name for name, _ in reflection_fields(reflection.get('partition_columns'))]
+    config['localsort_by'] = [name for name, _ in reflection_fields(reflection.get('sort_columns'))]
+    config['distribute_by'] = [name for name, _ in reflection_fields(reflection.get('distribution_columns'))]
+    if reflection.get('arrow_caching_enabled') in (True, 'true'):
+        config['arrow_cache'] = True
+
+    arguments = ', '.join(f'{key}={value!r}' for key, value in config.items() if value not in ([], None))
+    return '{{ config(' + arguments + ') }}\n-- depends_on: ' + dependency + '\n'
+
+
+@instrumented('build_reflections')
+def build_reflections(self):
+    # reflection models next to the models of the views and in the folders of the source tables they
+    # accelerate, named after the dataset's model and the reflection
+    project_root = self.output + "/" + self.project_name + "/"
+    models_root = project_root + "models/"
+    written = set()
+
+    datasets = [(table, 'table') for table in self.tables] + [(view, 'view') for view in self.filtered_views]
+    for dataset, dataset_type in datasets:
+        path = parse_path(dataset['path'])
+        reflections = self.reflection_index.get(path.unquoted)
+        if not reflections:
+            continue
+
+        if dataset_type == 'view':
+            dependency = "{{ ref('" + path.model_name + "') }}"
+        else:
+            dependency = "{{ source('" + path.source_name + "', '" + path.alias + "') }}"
+
+        names = set()
+        for reflection in reflections:
+            name = path.model_name + '__' + re.sub(r'[^A-Za-z0-9_]+', '_', reflection['reflection_name']).strip('_')
+            while name in names:
+                name += '_'
+            names.add(name)
+
+            model_path = models_root + "/".join(path.schema)
+            write_model({'path': model_path,
+                         'file': model_path + '/' + name + '.sql',
+                         'sql': reflection_sql(reflection, dependency)})
+            written.add(os.path.relpath(model_path + '/' + name + '.sql', project_root))
+
+    remove_reflection_files(self, written)
+    print(f'{datetime.now()} - {len(written)} reflections built')
+
+
+def remove_reflection_files(self, written=()):
+    # reflection models of the last export that weren't written again, the reflection was dropped in
+    # dremio or reflections were turned off since
+    project_root = self.output + "/" + self.project_name + "/"
+    for name in read_manifest(self).get('reflection_files', []):
+        if name not in written and os.path.exists(project_root + name):
+            print(f'{datetime.now()} - removing reflection {name}')
+            os.remove(project_root + name)
+    write_manifest(self, reflection_files=sorted(written))
+
+
+def export_target(self, args, mp_context=None):
+    if self.local:
+        print("Getting local tables")
+        get_local_tables(self)
+        print("Getting local views")
+        get_local_views(self)
+        if self.columns:
+            get_local_columns(self)
+        if self.reflections:
+            get_local_reflections(self)
+    else:
+        print("Getting tables and views")
+        get_catalog(self, refresh=args.refresh, record=args.record, lineage=bool(args.select or args.graph))
+    print("building model")
+    build_model(self, workers=args.workers, incremental=args.incremental, prune=args.prune,
+                select=args.select, graph=args.graph, mp_context=mp_context)
+    if self.reflections:
+        print("building reflections")
+        build_reflections(self)
+    elif read_manifest(self).get('reflection_files'):
+        remove_reflection_files(self)
+    print("building schema and project yaml")
+    build_yaml(self)
+
+
+def export_targets(config, targets, args):
+    # export several targets from one process, up to args.concurrency at a time. targets on the same
+    # dremio share a session, the same parse_cache_file shares the cache and one failing target, its
+    # config included, doesn't stop the others. returns {target: error or None}
+    targets = list(dict.fromkeys(targets))
+    dremio_conns = {}
+    projects = {}
+    results = {}
+    for target in targets:
+        try:
+            dremio_conn = DremioConfig(config, target)
+            if args.profile:
+                dremio_conn.metrics.profile_dir = os.path.join(args.profile, target)
+
+            # every target needs a dbt project of its own
+            project = os.path.abspath(os.path.join(dremio_conn.output, dremio_conn.project_name))
+            if project in projects:
+                raise DremioError(f'targets {projects[project]} and {target} both export to {project}')
+        except Exception as e:
+            print(f'{datetime.now()} - {target} failed: {type(e).__name__}: {e}')
+            results[target] = (f'{type(e).__name__}: {e}', 0.0)
+            continue
+        projects[project] = target
+        dremio_conns[target] = dremio_conn
+
+    # targets on the same dremio share a session with connections for as many of them as run at once
+    same_url = {}
+    for dremio_conn in dremio_conns.values():
+        same_url.setdefault(dremio_conn.url, []).append(dremio_conn)
+    for conns in same_url.values():
+        session = new_session(max(conn.pool_size for conn in conns) * min(args.concurrency, len(conns)))
+        for conn in conns:
+            conn.client.session = session
+
+    # worker processes are started from a fork server, forking this process while other
+    # targets' threads hold locks could leave the workers deadlocked
+    mp_context = multiprocessing.get_context('forkserver') if len(targets) > 1 and args.workers > 1 else None
+
+    def run(target):
+        start = perf_counter()
+        try:
+            export_target(dremio_conns[target], args, mp_context)
+            return None, perf_counter() - start
+        except Exception as e:
+            print(f'{datetime.now()} - {target} failed: {type(e).__name__}: {e}')
+            return f'{type(e).__name__}: {e}', perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, min(args.concurrency, len(dremio_conns)))) as executor:
+        results.update(zip(dremio_conns, executor.map(run, dremio_conns)))
+
+    print(f'{"target":<30} {"status":<7} {"seconds":>8} {"models":>7}  error')
+    for target in targets:
+        error, seconds = results[target]
+        counters = dremio_conns[target].metrics.counters if target in dremio_conns else {}
+        print(f'{target:<30} {"failed" if error else "ok":<7} {seconds:>8.1f} '
+              f'{counters.get("models_built", 0):>7}  {error or ""}')
+
+    if args.metrics:
+        with open(args.metrics, 'w') as file:
+            json.dump({target: dremio_conn.metrics.report() for target, dremio_conn in dremio_conns.items()},
+                      file, indent=2)
+
+    return {target: results[target][0] for target in targets}
 
 
 if __name__ == "__main__":
@@ -510,41 +1984,44 @@ if __name__ == "__main__":
         prog='dremio-dbt-exporter',
         description='exports an existing dremio environment to a dbt model')
     parser.add_argument('-config', default='config.ini')
-    parser.add_argument('-target')
+    parser.add_argument('-target', nargs='+', default=[])
+    parser.add_argument('-all', action='store_true')
+    parser.add_argument('-concurrency', type=int, default=4)
+    parser.add_argument('-workers', type=int, default=1)
+    parser.add_argument('-incremental', action='store_true')
+    parser.add_argument('-prune', action='store_true')
+    parser.add_argument('-refresh', action='store_true')
+    parser.add_argument('-record', action='store_true')
+    parser.add_argument('-select', nargs='+')
+    parser.add_argument('-graph')
+    parser.add_argument('-metrics')
+    parser.add_argument('-profile')
 
     # read args
     args = parser.parse_args()
     config_file = args.config
-    config_section = args.target
 
     # get the config properties
     config = configparser.ConfigParser()
     config.read(config_file)
+    targets = config.sections() if args.all else args.target
+    if not targets:
+        parser.error('give one or more -target sections or -all')
 
     # set config
-    dremio_conn = DremioConfig(config)
-    if dremio_conn.local:
-        print("Getting local tables")
-        get_local_tables(dremio_conn)
-        print("Getting local views")
-        get_local_views(dremio_conn)
-    else:
-        print("Getting tables")
-        get_tables(dremio_conn)
-        print("Getting views")
-        get_views(dremio_conn)
-        print("Getting filtered tables")
-        get_filtered_tables(dremio_conn)
-        print("Getting filterd views")
-        get_filtered_views(dremio_conn)
-    print("building model")
-    build_model(dremio_conn)
-    print("building source models")
-    build_source_yaml(dremio_conn)
-    print("building schema models")
-    build_schema_models_yaml(dremio_conn)
-    print("building project_yaml")
-    build_project_yaml(dremio_conn)
-
-
-
+    try:
+        if len(targets) == 1:
+            dremio_conn = DremioConfig(config, targets[0])
+            dremio_conn.metrics.profile_dir = args.profile
+            export_target(dremio_conn, args)
+            if args.metrics:
+                dremio_conn.metrics.write(args.metrics)
+        else:
+            if args.graph:
+                parser.error('-graph takes a single target')
+            errors = export_targets(config, targets, args)
+            if any(errors.values()):
+                sys.exit(1)
+    except DremioError as e:
+        print(f'{datetime.now()} - {e}')
+        sys.exit(1)
@@ -0,0 +1,169 @@
+import argparse
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class DremioStub:
+    # a fake dremio rest api for exercising the exporter without a cluster. it serves software
+    # (/apiv2/login, /api/v3/...) and cloud (/v0/projects/<id>/...) paths: sql, job/<id>, job/<id>/results
+    # and catalog. queries are answered from the tables/views/columns/reflections rows handed in,
+    # picked by the name of the system table in the sql, with the filters the exporter generates
+    # (shard, path in, projection) applied. failures are injected per endpoint with fail()
+    def __init__(self, rows=None, job_delay=0.05, max_limit=500, port=0):
+        self.rows = rows or {}
+        self.job_delay = job_delay
+        self.max_limit = max_limit
+        self.jobs = {}
+        self.failures = {}
+        self.requests = []
+        self.logins = 0
+        self.expired = set()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.handle(self, 'GET')
+
+            def do_POST(self):
+                stub.handle(self, 'POST')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail(self, endpoint, *responses):
+        # the next requests to endpoint (login, sql, job, results or catalog) get these responses,
+        # a status code or (status code, headers)
+        with self.lock:
+            self.failures.setdefault(endpoint, []).extend(responses)
+
+    def expire(self):
+        # tokens handed out so far are turned away with a 401 from now on
+        with self.lock:
+            self.expired.update(f'Bearer token{login}' for login in range(1, self.logins + 1))
+
+    def count(self, endpoint):
+        return sum(1 for _, name in self.requests if name == endpoint)
+
+    def handle(self, handler, method):
+        url = urlparse(handler.path)
+        parts = url.path.strip('/').split('/')
+        body = handler.rfile.read(int(handler.headers.get('Content-Length', 0)))
+
+        if url.path == '/apiv2/login':
+            endpoint = 'login'
+        elif parts[-1] in ('sql', 'catalog', 'results'):
+            endpoint = parts[-1]
+        elif len(parts) > 1 and parts[-2] == 'job':
+            endpoint = 'job'
+        else:
+            return self.send(handler, 404, {})
+
+        with self.lock:
+            self.requests.append((method, endpoint))
+            failures = self.failures.get(endpoint)
+            failure = failures.pop(0) if failures else None
+        if failure is not None:
+            status, headers = failure if isinstance(failure, tuple) else (failure, {})
+            return self.send(handler, status, {'errorMessage': 'injected'}, headers)
+        if endpoint != 'login' and handler.headers.get('Authorization') in self.expired:
+            return self.send(handler, 401, {'errorMessage': 'token expired'})
+
+        if endpoint == 'login':
+            with self.lock:
+                self.logins += 1
+                token = f'token{self.logins}'
+            return self.send(handler, 200, {'token': token})
+        if endpoint == 'sql':
+            job_id = f'job{next(self.ids)}'
+            sql = json.loads(body)['sql']
+            self.jobs[job_id] = (time.time(), self.query(sql))
+            return self.send(handler, 200, {'id': job_id})
+        if endpoint == 'catalog':
+            top = list(dict.fromkeys(row['path'][1:].split(',')[0]
+                                     for kind in ('tables', 'views') for row in self.rows.get(kind, [])))
+            return self.send(handler, 200, {'data': [{'path': [name], 'type': 'CONTAINER'} for name in top]})
+        if endpoint == 'results':
+            query = parse_qs(url.query)
+            offset, limit = int(query['offset'][0]), int(query['limit'][0])
+            if limit > self.max_limit:
+                return self.send(handler, 400, {'errorMessage': f'limit is limited to {self.max_limit}'})
+            return self.send(handler, 200, {'rows': self.jobs[parts[-2]][1][offset:offset + limit]})
+
+        started, rows = self.jobs[parts[-1]]
+        state = 'COMPLETED' if time.time() - started >= self.job_delay else 'RUNNING'
+        return self.send(handler, 200, {'jobState': state, 'rowCount': len(rows)})
+
+    def query(self, sql):
+        for kind in ('reflections', 'columns', 'views', 'tables'):
+            if kind in sql.lower():
+                break
+        rows = [dict(row) for row in self.rows.get(kind, [])]
+
+        prefixes = [prefix.replace('\\', '') for prefix in re.findall(r"like '([^']*),%'", sql)]
+        if prefixes:
+            rows = [row for row in rows if any(row['path'].startswith(prefix + ',') for prefix in prefixes)]
+        match = re.search(r'"path" in \((.*)\)', sql)
+        if match:
+            paths = {path.replace("''", "'") for path in re.findall(r"'((?:[^']|'')*)'", match.group(1))}
+            rows = [row for row in rows if row['path'] in paths]
+        match = re.match(r'select ((?:"\w+", )*"\w+") from', sql)
+        if match:
+            columns = re.findall(r'"(\w+)"', match.group(1))
+            rows = [{column: row.get(column) for column in columns} for row in rows]
+        return rows
+
+    def send(self, handler, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+def read_ndjson(file_name):
+    with open(file_name) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+if __name__ == "__main__":
+    # serve recorded catalogs, for pointing a live mode target at: python tests/dremio_stub.py -port 9047 ...
+    parser = argparse.ArgumentParser(description='fake dremio rest api serving ndjson catalogs')
+    parser.add_argument('-port', type=int, default=9047)
+    parser.add_argument('-tables')
+    parser.add_argument('-views')
+    parser.add_argument('-columns')
+    parser.add_argument('-reflections')
+    parser.add_argument('-job-delay', dest='job_delay', type=float, default=0.05)
+    args = parser.parse_args()
+
+    rows = {kind: read_ndjson(getattr(args, kind))
+            for kind in ('tables', 'views', 'columns', 'reflections') if getattr(args, kind)}
+    stub = DremioStub(rows, job_delay=args.job_delay, port=args.port)
+    print(f'serving on http://127.0.0.1:{stub.port}')
+    stub.server.serve_forever()
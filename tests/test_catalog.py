@@ -0,0 +1,108 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import (DremioError, NDJSONRows, get_catalog, get_datasets, get_local_columns,  # noqa: E402
+                  get_local_reflections, get_local_tables, get_local_views, run_queries, run_sharded)
+from tests.dremio_stub import DremioStub  # noqa: E402
+from tests.test_client import stub_config  # noqa: E402
+
+TABLES = [{'table_name': name, 'path': f'[{space}, {name}]', 'tag': 't1'}
+          for space in ('src', 'lake') for name in ('orders', 'customers', 'events')]
+VIEWS = [{'view_name': f'v_{x}', 'path': f'[Analytics, {folder}, v_{x}]', 'sql_context': None, 'tag': 't1',
+          'sql_definition': f'select {x} from src.orders'}
+         for x, folder in enumerate(['sales', 'sales', 'reports', 'reports', 'hr'])]
+COLUMNS = [{'TABLE_SCHEMA': 'src', 'TABLE_NAME': 'orders', 'COLUMN_NAME': name, 'ORDINAL_POSITION': position,
+            'DATA_TYPE': 'INTEGER'} for position, name in enumerate(['id', 'cid'], 1)]
+REFLECTIONS = [{'reflection_name': 'raw', 'type': 'RAW', 'dataset_name': 'src.orders', 'display_columns': 'id',
+                'is_enabled': True, 'external_reflection': None}]
+TABLE_QUERY = 'select * from sys."tables"'
+
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.rows = {'tables': [dict(row) for row in TABLES], 'views': [dict(row) for row in VIEWS],
+                     'columns': COLUMNS, 'reflections': REFLECTIONS}
+        self.stub = DremioStub(self.rows, job_delay=0.01).start()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.stub.stop()
+        shutil.rmtree(self.directory)
+
+    def test_fresh_snapshot_is_reused(self):
+        dremio_conn = stub_config(self.stub, snapshot_dir=self.directory)
+        rows = run_queries(dremio_conn, {'tables': TABLE_QUERY})['tables']
+        jobs = self.stub.count('sql')
+
+        self.assertEqual(run_queries(dremio_conn, {'tables': TABLE_QUERY})['tables'], rows)
+        self.assertEqual(self.stub.count('sql'), jobs)
+
+    def test_refresh_fetches_edited_and_new_rows(self):
+        dremio_conn = stub_config(self.stub, snapshot_dir=self.directory)
+        run_queries(dremio_conn, {'tables': TABLE_QUERY})
+
+        self.rows['tables'][0].update(table_name='orders_v2', tag='t2')
+        del self.rows['tables'][1]
+        self.rows['tables'].append({'table_name': 'new', 'path': '[src, new]', 'tag': 't1'})
+        rows = run_queries(dremio_conn, {'tables': TABLE_QUERY}, refresh=True)['tables']
+
+        self.assertEqual(rows, self.rows['tables'])
+        self.assertEqual(run_queries(dremio_conn, {'tables': TABLE_QUERY})['tables'], self.rows['tables'])
+
+    def test_refresh_needs_the_tag(self):
+        for row in self.rows['tables']:
+            del row['tag']
+        dremio_conn = stub_config(self.stub, snapshot_dir=self.directory)
+        run_queries(dremio_conn, {'tables': TABLE_QUERY})
+
+        with self.assertRaises(DremioError):
+            run_queries(dremio_conn, {'tables': TABLE_QUERY}, refresh=True)
+
+    def test_failed_shard_is_retried(self):
+        dremio_conn = stub_config(self.stub, shard='true', shard_concurrency='2', shard_retries='1')
+        self.stub.fail('sql', 400)
+        rows = run_sharded(dremio_conn, {'tables': TABLE_QUERY})['tables']
+
+        self.assertEqual(rows, TABLES)
+        self.assertEqual(self.stub.count('catalog'), 1)
+        self.assertEqual(dremio_conn.metrics.counters['shard_retries'], 1)
+
+    def test_projection_fetches_definitions_of_filtered_views(self):
+        dremio_conn = stub_config(self.stub, client_filter='true', view_path_filter='Analytics.reports.*',
+                                  definition_batch_size='1')
+        get_datasets(dremio_conn)
+
+        self.assertEqual([list(row) for row in dremio_conn.tables], [['path']] * len(TABLES))
+        self.assertEqual([list(row) for row in dremio_conn.views], [['path', 'sql_context']] * len(VIEWS))
+        self.assertEqual([view['sql_definition'] for view in dremio_conn.filtered_views],
+                         [VIEWS[2]['sql_definition'], VIEWS[3]['sql_definition']])
+        # the table and view catalogs and a job per batch of one definition
+        self.assertEqual(self.stub.count('sql'), 4)
+
+    def test_recorded_catalogs_replay_in_local_mode(self):
+        files = {key: os.path.join(self.directory, f'{key}.json.gz')
+                 for key in ('local_table_json', 'local_view_json', 'local_column_json', 'local_reflection_json')}
+        live = stub_config(self.stub, columns='true', reflections='true', **files)
+        get_catalog(live, record=True)
+
+        local = stub_config(self.stub, local='true', columns='true', reflections='true', **files)
+        get_local_tables(local)
+        get_local_views(local)
+        get_local_columns(local)
+        get_local_reflections(local)
+
+        self.assertEqual(list(NDJSONRows(files['local_table_json'])), TABLES)
+        self.assertEqual(list(local.tables), live.tables)
+        self.assertEqual(list(local.views), live.views)
+        self.assertEqual(list(local.filtered_views), live.filtered_views)
+        self.assertEqual(local.column_index, live.column_index)
+        self.assertEqual(local.reflection_index, live.reflection_index)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import configparser
+import os
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import DremioConfig, DremioError, execute_query  # noqa: E402
+from tests.dremio_stub import DremioStub  # noqa: E402
+
+TABLES = [{'table_name': f'table_{x}', 'path': f'[src, sales, table_{x}]', 'created': f'2024-01-01 00:00:{x:02d}'}
+          for x in range(25)]
+
+
+def stub_config(stub, **options):
+    config = configparser.ConfigParser()
+    config['stub'] = {'type': 'software', 'host': '127.0.0.1', 'port': str(stub.port), 'ssl': 'false',
+                      'username': 'dremio', 'password': 'dremio', 'project_name': 'stub', 'output': 'project',
+                      'view_query': 'select * from sys."views"', 'view_filter': '',
+                      'table_query': 'select * from sys."tables"', 'table_filter': '',
+                      'local': 'false', 'local_view_json': '', 'local_table_json': '',
+                      'retries': '3', 'retry_backoff': '0.01', 'poll_min': '0.01', 'poll_max': '0.05',
+                      'page_size': '10'}
+    config['stub'].update(options)
+    return DremioConfig(config, 'stub')
+
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = DremioStub({'tables': TABLES}).start()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_pages_come_back_in_order(self):
+        rows = execute_query(stub_config(self.stub), 'select * from sys."tables"')
+        self.assertEqual(rows, TABLES)
+        self.assertEqual(self.stub.count('results'), 3)
+
+    def test_retries_429_and_5xx(self):
+        self.stub.fail('sql', (429, {'Retry-After': '0'}))
+        self.stub.fail('job', 503)
+        self.stub.fail('results', 502, 500)
+
+        rows = execute_query(stub_config(self.stub), 'select * from sys."tables"')
+        self.assertEqual(rows, TABLES)
+        self.assertEqual(self.stub.count('sql'), 2)
+        self.assertEqual(self.stub.count('results'), 5)
+
+    def test_gives_up_after_retries(self):
+        self.stub.fail('sql', 503, 503, 503)
+        with self.assertRaises(DremioError):
+            execute_query(stub_config(self.stub, retries='2'), 'select * from sys."tables"')
+        self.assertEqual(self.stub.count('sql'), 3)
+
+    def test_logs_in_again_after_401(self):
+        self.stub.fail('job', 401)
+
+        rows = execute_query(stub_config(self.stub), 'select * from sys."tables"')
+        self.assertEqual(rows, TABLES)
+        self.assertEqual(self.stub.logins, 2)
+
+    def test_threads_share_one_login(self):
+        dremio_conn = stub_config(self.stub)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: execute_query(dremio_conn, 'select * from sys."tables"'), range(4)))
+        self.assertEqual(results, [TABLES] * 4)
+        self.assertEqual(self.stub.logins, 1)
+
+    def test_threads_share_the_login_after_401(self):
+        dremio_conn = stub_config(self.stub)
+        dremio_conn.client.login()
+        self.stub.expire()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: execute_query(dremio_conn, 'select * from sys."tables"'), range(4)))
+        self.assertEqual(results, [TABLES] * 4)
+        self.assertEqual(self.stub.logins, 2)
+
+    def test_bad_response_raises(self):
+        self.stub.fail('sql', 400)
+        with self.assertRaises(DremioError):
+            execute_query(stub_config(self.stub), 'select * from sys."tables"')
+
+
+if __name__ == "__main__":
+    unittest.main()
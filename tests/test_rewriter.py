@@ -0,0 +1,91 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import DREMIO_RESERVED, ModelRewriter  # noqa: E402
+
+
+def ref(name):
+    return "{{ ref('" + name.split('.')[-1] + "') }}"
+
+
+class RewriterTest(unittest.TestCase):
+    def setUp(self):
+        self.rewriter = ModelRewriter(DREMIO_RESERVED)
+
+    def references(self, sql):
+        return [name for _, _, name in self.rewriter.table_references(self.rewriter.tokenize(sql))]
+
+    def render(self, sql):
+        tokens = self.rewriter.tokenize(sql)
+        references = self.rewriter.table_references(tokens)
+        return self.rewriter.render(tokens, references, {name: ref(name) for _, _, name in references})
+
+    def test_prefix_of_a_longer_name(self):
+        sql = 'select * from Sales.curated.orders o join Sales.curated.orders_archive a on o.id = a.id'
+        self.assertEqual(self.references(sql), ['Sales.curated.orders', 'Sales.curated.orders_archive'])
+        model = self.render(sql)
+        self.assertIn("from {{ ref('orders') }} o", model)
+        self.assertIn("join {{ ref('orders_archive') }} a", model)
+        self.assertNotIn('}}_archive', model)
+
+    def test_cte_names_are_not_tables(self):
+        sql = 'with recent as (select * from Sales.curated.orders), archived as (select * from recent) ' \
+              'select * from recent join archived on recent.id = archived.id'
+        self.assertEqual(self.references(sql), ['Sales.curated.orders'])
+        model = self.render(sql)
+        self.assertIn("from {{ ref('orders') }}", model)
+        self.assertIn('from recent', model)
+        self.assertIn('join archived', model)
+
+    def test_subquery(self):
+        sql = 'select * from a.b.c where id in (select id from a.b.d)'
+        self.assertEqual(self.references(sql), ['a.b.c', 'a.b.d'])
+        self.assertIn("from {{ ref('d') }}", self.render(sql))
+
+    def test_from_inside_functions(self):
+        sql = 'select extract(year from o.created) as y, substring(o.name from 2) from a.b.orders o'
+        self.assertEqual(self.references(sql), ['a.b.orders'])
+        model = self.render(sql)
+        self.assertIn('o.created', model)
+        self.assertIn("from {{ ref('orders') }} o", model)
+
+    def test_comma_join_after_on(self):
+        sql = 'select * from a.b.x join a.b.y on x.id = y.id, a.b.z where z.id = x.id'
+        self.assertEqual(self.references(sql), ['a.b.x', 'a.b.y', 'a.b.z'])
+        self.assertIn("{{ ref('z') }}", self.render(sql))
+
+    def test_backticks_are_requoted(self):
+        sql = 'select o.`date`, o.`user`, o.`amount` from `Sales`.`curated`.`orders` o'
+        self.assertEqual(self.references(sql), ['Sales.curated.orders'])
+        model = self.render(sql)
+        self.assertIn('o."date"', model)
+        self.assertIn('o."user"', model)
+        self.assertIn('o.amount', model)
+        self.assertNotIn('`', model)
+
+    def test_tables_named_like_keywords(self):
+        sql = 'select e.id from events e join data d on e.id = d.id left join source s on s.id = e.id, user u'
+        self.assertEqual(self.references(sql), ['events', 'data', 'source', 'user'])
+        model = self.render(sql)
+        for name in ('events', 'data', 'source', 'user'):
+            self.assertIn(ref(name), model)
+
+    def test_is_distinct_from_is_not_a_table(self):
+        sql = 'select o.id from a.b.orders o join a.b.old p on o.id = p.id ' \
+              'where o.s is distinct from p.s or o.t is not distinct from p.t'
+        self.assertEqual(self.references(sql), ['a.b.orders', 'a.b.old'])
+        model = self.render(sql)
+        self.assertIn('p.s', model)
+        self.assertIn('p.t', model)
+
+    def test_table_functions_are_not_tables(self):
+        sql = 'select * from table(flatten(a.b.c))'
+        self.assertEqual(self.references(sql), [])
+        self.assertIn('table(flatten(a.b.c))', self.render(sql))
+
+
+if __name__ == "__main__":
+    unittest.main()